@@ -0,0 +1,95 @@
+"""
+Microbenchmark: CPU cost of building one page of the question list
+
+Compares the ORM read path (hydrate Question objects, Question.format(),
+flask.jsonify) with the column-only path the list endpoints use
+(question_rows(), format_row(), flaskr.encoding.jsonify). Runs against an
+in-memory SQLite database, so it needs no Postgres server:
+
+    python benchmarks/list_serialization.py [--questions 10000] [--runs 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask, jsonify as flask_jsonify  # noqa: E402
+
+from models import db, setup_db, create_schema, Question, Category, \
+    question_rows, format_row  # noqa: E402
+from flaskr import QUESTIONS_PER_PAGE  # noqa: E402
+from flaskr.encoding import jsonify, JSON_ENCODER  # noqa: E402
+
+
+def seed(questions):
+    db.session.execute(Category.__table__.insert().values(
+        [{'id': id, 'type': 'Category {}'.format(id)} for id in range(1, 7)]))
+    db.session.execute(Question.__table__.insert().values([{
+        'question': 'Synthetic question number {}?'.format(number),
+        'answer': 'Answer {}'.format(number),
+        'category': number % 6 + 1,
+        'difficulty': number % 5 + 1
+    } for number in range(questions)]))
+    db.session.commit()
+
+
+def orm_page(offset):
+    questions = Question.query.order_by(Question.id).offset(offset) \
+        .limit(QUESTIONS_PER_PAGE).all()
+    response = flask_jsonify({
+        'success': True,
+        'questions': [question.format() for question in questions]
+    })
+    db.session.remove()
+    return response
+
+
+def column_page(offset):
+    rows = question_rows().order_by(Question.id).offset(offset) \
+        .limit(QUESTIONS_PER_PAGE).all()
+    response = jsonify({
+        'success': True,
+        'questions': [format_row(row) for row in rows]
+    })
+    db.session.remove()
+    return response
+
+
+def measure(build_page, runs, pages):
+    started = time.process_time()
+    for run in range(runs):
+        build_page((run % pages) * QUESTIONS_PER_PAGE)
+    return (time.process_time() - started) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+    with app.test_request_context():
+        create_schema(db.engine)
+        seed(args.questions)
+        pages = args.questions // QUESTIONS_PER_PAGE
+        # warm up both paths before measuring
+        measure(orm_page, 100, pages)
+        measure(column_page, 100, pages)
+
+        orm = measure(orm_page, args.runs, pages)
+        columns = measure(column_page, args.runs, pages)
+
+    print('{:<44}{:8.1f} us/request'.format(
+        'ORM objects + format() + flask.jsonify:', orm * 1e6))
+    print('{:<44}{:8.1f} us/request'.format(
+        'columns + format_row() + {} jsonify:'.format(JSON_ENCODER),
+        columns * 1e6))
+    print('CPU per request reduced by {:.0%}'.format(1 - columns / orm))
+
+
+if __name__ == '__main__':
+    main()
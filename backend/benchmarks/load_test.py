@@ -0,0 +1,374 @@
+"""
+Load test: latency, throughput and SQL statements of the API routes
+
+Seeds the database configured by DB_HOST/DB_USER/DB_PASSWORD/DB_NAME, or
+given with --database-url, with synthetic questions (see
+benchmarks/synthetic.py), then runs every
+scenario through the app in-process and reports the p50/p99 latency, the
+throughput and the SQL statements per request. Results are saved as JSON
+so runs on two commits can be compared:
+
+    DB_NAME=trivia_bench python benchmarks/load_test.py --seed 100000 \\
+        --output before.json
+    DB_NAME=trivia_bench python benchmarks/load_test.py \\
+        --compare before.json --output after.json
+    python benchmarks/load_test.py --database-url sqlite:////tmp/bench.db \\
+        --seed 20000
+
+Bulk import and export are not scenarios: `flask import-questions`
+reports its own rows per second.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func  # noqa: E402
+
+from models import db, setup_db, create_schema, Question, Category, \
+    category_registry  # noqa: E402
+from flaskr import create_app, QUESTIONS_PER_PAGE  # noqa: E402
+from flaskr.bulk import import_questions  # noqa: E402
+from flaskr.encoding import JSON_ENCODER  # noqa: E402
+from synthetic import synthetic_lines, VOCABULARY, \
+    CATEGORY_TYPES  # noqa: E402
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+SCENARIOS = []
+
+
+def scenario(name):
+    def register(function):
+        SCENARIOS.append((name, function))
+        return function
+    return register
+
+
+"""
+Workload
+    what the scenarios draw their requests from: the id range, the
+    category ids and page counts of the seeded database, and the ids of
+    the questions the create scenario added, for the delete scenario
+"""
+
+
+class Workload:
+
+    def __init__(self):
+        self.min_id, self.max_id = db.session.query(
+            func.min(Question.id), func.max(Question.id)).one()
+        self.total = db.session.query(func.count(Question.id)).scalar()
+        self.categories = sorted(category_registry.as_dict())
+        self.pages = max(math.ceil(self.total / QUESTIONS_PER_PAGE), 1)
+        self.category_pages = max(self.pages // len(self.categories), 1)
+        self.created = deque()
+
+    def random_ids(self, rng, count):
+        return [rng.randint(self.min_id, self.max_id) for _ in range(count)]
+
+
+@scenario('categories')
+def categories(client, workload, rng):
+    return client.get('/api/v1/categories')
+
+
+@scenario('stats')
+def stats(client, workload, rng):
+    return client.get('/api/v1/stats')
+
+
+@scenario('list_first_page')
+def list_first_page(client, workload, rng):
+    return client.get('/api/v1/questions?page=1')
+
+
+@scenario('list_deep_page')
+def list_deep_page(client, workload, rng):
+    page = rng.randint(max(workload.pages - 10, 1), workload.pages)
+    return client.get('/api/v1/questions?page={}'.format(page))
+
+
+@scenario('list_after_id')
+def list_after_id(client, workload, rng):
+    after_id = rng.randint(workload.min_id, workload.max_id)
+    return client.get('/api/v1/questions?after_id={}'.format(after_id))
+
+
+@scenario('multi_get')
+def multi_get(client, workload, rng):
+    ids = ','.join(str(id) for id in workload.random_ids(rng, 20))
+    return client.get('/api/v1/questions?ids={}'.format(ids))
+
+
+@scenario('category_filter')
+def category_filter(client, workload, rng):
+    return client.get('/api/v1/categories/{}/questions?page={}'.format(
+        rng.choice(workload.categories),
+        rng.randint(1, workload.category_pages)))
+
+
+@scenario('search')
+def search(client, workload, rng):
+    return client.post('/api/v1/questions/search',
+                       json={'searchTerm': rng.choice(VOCABULARY)})
+
+
+@scenario('quiz')
+def quiz(client, workload, rng):
+    return client.post('/api/v1/quizzes', json={
+        'previous_questions': workload.random_ids(rng, 20),
+        'quiz_category': {'id': rng.choice([0] + workload.categories)}
+    })
+
+
+@scenario('quiz_batch')
+def quiz_batch(client, workload, rng):
+    return client.post('/api/v1/quizzes', json={
+        'previous_questions': workload.random_ids(rng, 20),
+        'quiz_category': {'id': rng.choice([0] + workload.categories)},
+        'count': 10
+    })
+
+
+@scenario('quiz_session')
+def quiz_session(client, workload, rng):
+    # starts a quiz and draws its first question
+    response = client.post('/api/v1/quizzes/sessions', json={
+        'quiz_category': {'id': rng.choice(workload.categories)}})
+    if response.status_code != 200:
+        return response
+    return client.post('/api/v1/quizzes/sessions/{}/next'.format(
+        response.get_json()['session_id']))
+
+
+@scenario('create')
+def create(client, workload, rng):
+    response = client.post('/api/v1/questions', json={
+        'question': 'Load test question {}?'.format(rng.random()),
+        'answer': 'Load test',
+        'category': rng.choice(workload.categories),
+        'difficulty': rng.randint(1, 5)
+    }, headers={'Prefer': 'return=minimal'})
+    if response.status_code == 200:
+        workload.created.append(response.get_json()['created'])
+    return response
+
+
+@scenario('delete')
+def delete(client, workload, rng):
+    # removes what the create scenario added, so the data set is unchanged
+    # once a run is over
+    try:
+        question_id = workload.created.popleft()
+    except IndexError:
+        question_id = workload.max_id + 1
+    return client.delete('/api/v1/questions/{}'.format(question_id),
+                         headers={'Prefer': 'return=minimal'})
+
+
+def percentile(values, percent):
+    rank = math.ceil(percent / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+"""
+run_scenario(app, function, workload, requests, concurrency)
+    sends `requests` requests of a scenario from `concurrency` threads and
+    returns their latency percentiles, throughput, SQL statements per
+    request and the number of error responses
+"""
+
+
+def run_scenario(app, function, workload, requests, concurrency):
+    lock = threading.Lock()
+    latencies = []
+    statements = []
+    errors = [0]
+
+    def worker(index, count):
+        client = app.test_client()
+        rng = random.Random(index)
+        for _ in range(count):
+            started = time.perf_counter()
+            response = function(client, workload, rng)
+            elapsed = time.perf_counter() - started
+            queries = SERVER_TIMING_QUERIES.search(
+                response.headers.get('Server-Timing', ''))
+            with lock:
+                latencies.append(elapsed)
+                if queries:
+                    statements.append(int(queries.group(1)))
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(
+        index, requests // concurrency +
+        (1 if index < requests % concurrency else 0)))
+        for index in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'sql_per_request': round(sum(statements) / len(statements), 2)
+        if statements else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(questions, batch_size):
+    # provisions the schema and tops the database up to `questions`
+    # questions, adding the sample categories to a database without any
+    create_schema(db.engine)
+    if not category_registry.as_dict():
+        for type in CATEGORY_TYPES:
+            Category(type).insert()
+    existing = db.session.query(func.count(Question.id)).scalar()
+    if existing >= questions:
+        return
+    summary = import_questions(
+        synthetic_lines(questions - existing,
+                        sorted(category_registry.as_dict()), seed=existing),
+        batch_size=batch_size)
+    print('seeded {imported} questions in {elapsed_seconds}s '
+          '({rows_per_second} rows/s)'.format(**summary))
+
+
+def compare(baseline, results):
+    print('\ncompared to {}'.format(baseline['meta'].get('commit')))
+    print('{:<18}{:>26}{:>26}{:>26}'.format(
+        'scenario', 'p50 ms', 'p99 ms', 'requests/s'))
+    for name, after in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps'):
+            change = (after[key] / before[key] - 1) if before[key] else 0
+            cells.append('{:>9} -> {:<8}{:+.0%}'.format(
+                before[key], after[key], change))
+        print('{:<18}'.format(name) + ''.join(
+            '{:>26}'.format(cell) for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seed', type=int, default=0, metavar='QUESTIONS',
+                        help='first top the database up to this many '
+                             'synthetic questions (10000 to 1000000)')
+    parser.add_argument('--seed-batch-size', type=int, default=5000)
+    parser.add_argument('--database-url',
+                        help='SQLAlchemy URL of the database to test, by '
+                             'default the one DB_* configures')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='threads sending requests')
+    parser.add_argument('--scenarios',
+                        help='comma separated scenarios, by default all')
+    parser.add_argument('--no-response-cache', action='store_true',
+                        help='measure list pages without the response cache')
+    parser.add_argument('--question-snapshot', action='store_true',
+                        help='serve lists and quizzes from the shared '
+                             'question snapshot')
+    parser.add_argument('--output', help='file the JSON results are saved to')
+    parser.add_argument('--compare', type=argparse.FileType('r'),
+                        help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    config = {'SERVER_TIMING': True}
+    if args.no_response_cache:
+        config['RESPONSE_CACHE_BYTES'] = 0
+    if args.question_snapshot:
+        config['QUESTION_SNAPSHOT'] = True
+    app = create_app(config)
+    if args.database_url:
+        setup_db(app, args.database_url, [])
+
+    selected = SCENARIOS
+    if args.scenarios:
+        names = args.scenarios.split(',')
+        selected = [(name, function) for name, function in SCENARIOS
+                    if name in names]
+
+    with app.app_context():
+        if args.seed:
+            seed(args.seed, args.seed_batch_size)
+        workload = Workload()
+        dialect = db.engine.dialect.name
+    if not workload.total:
+        parser.error('the database has no questions; pass --seed')
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.utcnow().isoformat() + 'Z',
+            'questions': workload.total,
+            'database': dialect,
+            'json_encoder': JSON_ENCODER,
+            'write_behind': app.config['WRITE_BEHIND'],
+            'response_cache': not args.no_response_cache,
+            'question_snapshot': app.config['QUESTION_SNAPSHOT'],
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'python': platform.python_version()
+        },
+        'scenarios': {}
+    }
+
+    print('{} questions, {} requests per scenario from {} threads'.format(
+        workload.total, args.requests, args.concurrency))
+    print('{:<18}{:>10}{:>10}{:>12}{:>8}{:>8}'.format(
+        'scenario', 'p50 ms', 'p99 ms', 'requests/s', 'SQL', 'errors'))
+    for name, function in selected:
+        if args.warmup:
+            run_scenario(app, function, workload, args.warmup, 1)
+        stats = run_scenario(app, function, workload, args.requests,
+                             args.concurrency)
+        results['scenarios'][name] = stats
+        print('{:<18}{p50_ms:>10}{p99_ms:>10}{throughput_rps:>12}'
+              '{sql:>8}{errors:>8}'.format(
+                  name, sql=str(stats['sql_per_request']), **stats))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        compare(json.load(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
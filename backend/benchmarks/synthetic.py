@@ -0,0 +1,72 @@
+"""
+Synthetic question bank generator
+
+Yields any number of questions as NDJSON lines, spread evenly over the
+given categories and the five difficulties. Question texts are drawn from
+a fixed vocabulary so searches match a realistic share of the rows, and
+the same --seed always produces the same bank. The output is the input
+format of `flask import-questions`:
+
+    python benchmarks/synthetic.py --questions 100000 \\
+        | FLASK_APP=flaskr flask import-questions -
+"""
+import argparse
+import json
+import random
+import sys
+
+# words questions are made of; each is in about 1 in 20 questions
+VOCABULARY = (
+    'river', 'mountain', 'painter', 'planet', 'element', 'empire', 'novel',
+    'composer', 'ocean', 'island', 'king', 'queen', 'war', 'treaty',
+    'actor', 'film', 'album', 'team', 'league', 'record', 'desert',
+    'bridge', 'city', 'language', 'inventor', 'theory', 'species', 'gas',
+    'metal', 'festival', 'poet', 'sculptor', 'olympic', 'medal', 'volcano',
+    'lake', 'capital', 'border', 'symphony', 'galaxy'
+)
+TEMPLATES = (
+    'Which {} is known for the {} of {}?',
+    'What {} was first linked to a {} in {}?',
+    'Who named the {} after the {} in {}?',
+    'Where is the {} that inspired the {} of {}?'
+)
+DIFFICULTIES = (1, 2, 3, 4, 5)
+# the categories of trivia.psql, ids 1 to 6 in a fresh database
+CATEGORY_TYPES = ('Science', 'Art', 'Geography', 'History', 'Entertainment',
+                  'Sports')
+
+
+def synthetic_questions(count, categories=(1, 2, 3, 4, 5, 6), seed=0):
+    rng = random.Random(seed)
+    for number in range(count):
+        first, second = rng.sample(VOCABULARY, 2)
+        yield {
+            'question': rng.choice(TEMPLATES).format(
+                first, second, 1000 + number % 1000),
+            'answer': '{} {}'.format(second.capitalize(), number),
+            'category': categories[number % len(categories)],
+            'difficulty': DIFFICULTIES[number // len(categories) %
+                                       len(DIFFICULTIES)]
+        }
+
+
+def synthetic_lines(count, categories=(1, 2, 3, 4, 5, 6), seed=0):
+    for row in synthetic_questions(count, categories, seed):
+        yield json.dumps(row) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--categories', default='1,2,3,4,5,6',
+                        help='comma separated category ids')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    categories = [int(id) for id in args.categories.split(',') if id]
+    sys.stdout.writelines(
+        synthetic_lines(args.questions, categories, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,110 @@
 from functools import total_ordering
+import csv
 import os
 import re
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, request, abort, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, setup_db, create_schema, Question, \
+    question_counts, category_registry, question_search, question_ids, \
+    read_only, pool_status, question_rows, format_row, question_stats
+from migrations import applied_version, LATEST_VERSION
+from .quiz_sessions import QuizSessionStore
+from .bulk import import_questions, export_questions, IMPORT_BATCH_SIZE
+from .metrics import setup_metrics
+from .encoding import jsonify
+from .caching import conditional, cached, ResponseCache, \
+    RESPONSE_CACHE_BYTES
+from .snapshot import SnapshotStore, QUESTION_SNAPSHOT, QUESTION_SNAPSHOT_PATH
 
 QUESTIONS_PER_PAGE = 10
+MAX_SEARCH_RESULTS_PER_PAGE = 100
+MAX_QUIZ_BATCH = 50
+MAX_MULTI_GET_IDS = int(os.getenv('MAX_MULTI_GET_IDS', '100'))
 
 # a helper method for pagination
+#
+# `selection` is an unexecuted question_rows() query; the page is cut out
+# by the database with LIMIT/OFFSET (`?page=N`) or, for deep pages, with a
+# keyset cursor on the primary key (`?after_id=<last seen id>`), so only the
+# rows that are returned are ever loaded.
 
 
 def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    after_id = request.args.get('after_id', None, type=int)
+    offset = 0
+    if after_id is not None:
+        selection = selection.filter(Question.id > after_id)
+    else:
+        page = max(request.args.get('page', 1, type=int), 1)
+        offset = (page - 1) * QUESTIONS_PER_PAGE
+
+    current_questions = selection.order_by(Question.id).offset(
+        offset).limit(QUESTIONS_PER_PAGE).all()
+
+    return [format_row(row) for row in current_questions]
+
+
+# the same pages, read from the shared question snapshot
+
+
+def paginate_snapshot(request, snapshot, category=None):
+    after_id = request.args.get('after_id', None, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    return snapshot.page((page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE,
+                         category, after_id)
+
+
+# `Prefer: return=minimal` (RFC 7240), or a `fields` list without
+# `questions`, asks a write endpoint not to re-list the questions
+
+
+def wants_minimal_response(request):
+    if 'return=minimal' in request.headers.get('Prefer', ''):
+        return True
+    fields = request.args.get('fields')
+    return fields is not None and 'questions' not in fields.split(',')
+
+
+def minimal_response(body):
+    response = jsonify(body)
+    response.headers['Preference-Applied'] = 'return=minimal'
+    return response
+
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+# the keyset cursor a client should send as `after_id` to get the next page
 
-    return current_questions
+
+def next_cursor(current_questions):
+    if len(current_questions) < QUESTIONS_PER_PAGE:
+        return None
+    return current_questions[-1]['id']
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    metrics = setup_metrics(app)
+    quiz_sessions = QuizSessionStore()
+    response_cache = ResponseCache(
+        app.config.get('RESPONSE_CACHE_BYTES', RESPONSE_CACHE_BYTES))
+    app.config.setdefault('QUESTION_SNAPSHOT', QUESTION_SNAPSHOT)
+    question_snapshot = SnapshotStore(app.config.get(
+        'QUESTION_SNAPSHOT_PATH', QUESTION_SNAPSHOT_PATH))
+
+    # the list and quiz endpoints answer from the shared snapshot when
+    # snapshot mode is on and the image of the current data version is
+    # ready; None means they query the database
+    def current_snapshot():
+        if not app.config['QUESTION_SNAPSHOT']:
+            return None
+        return question_snapshot.current()
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -40,16 +117,97 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type, Authorization, true')
+                             'Content-Type, Authorization, Prefer, true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET, PUT, POST, DELETE, OPTIONS')
         return response
+
+    @app.route('/metrics')
+    def retrieve_metrics():
+
+        # `GET '/metrics'`
+
+        # - Per-endpoint request latency histograms, SQL statement counts, SQL time and rows fetched, in the Prometheus text format
+        # - Request Arguments: None
+        # - Returns: `text/plain` lines such as `trivia_sql_statements_total{endpoint="retrieve_questions"} 12`
+
+        return Response(metrics.render() + response_cache.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics/pool')
+    def retrieve_pool_status():
+
+        # `GET '/metrics/pool'`
+
+        # - The state of the database connection pools of the primary and of every read replica
+        # - Request Arguments: None
+        # - Returns: Per pool the connections in use and idle, the overflow, and how long checkouts waited for a connection.
+        '''json
+        {
+            "pools": {
+                "primary": {
+                    "checked_in": 4,
+                    "checked_out": 1,
+                    "checkouts": 5210,
+                    "overflow": 0,
+                    "pool": "queue",
+                    "size": 5,
+                    "timeouts": 0,
+                    "wait_seconds_max": 0.012,
+                    "wait_seconds_total": 0.184
+                }
+            },
+            "success": true
+        }
+        '''
+
+        return jsonify({
+            'success': True,
+            'pools': pool_status(app)
+        })
+
+    @app.route('/ready')
+    def readiness():
+
+        # `GET '/ready'`
+
+        # - Readiness probe: whether the primary database answers and its schema is fully migrated. Building the app does no database work, so workers report ready only through this check.
+        # - Request Arguments: None
+        # - Returns: The applied schema version; 503 while the database is unreachable or `flask migrate` has not been run.
+        '''json
+        {
+            "schema_version": 5,
+            "success": true
+        }
+        '''
+
+        try:
+            with db.engine.connect() as connection:
+                version = applied_version(connection)
+        except SQLAlchemyError:
+            return jsonify({
+                'success': False,
+                'error': 503,
+                'message': 'database unavailable'
+            }), 503
+
+        if version < LATEST_VERSION:
+            return jsonify({
+                'success': False,
+                'error': 503,
+                'message': 'database schema not migrated',
+                'schema_version': version
+            }), 503
+        return jsonify({'success': True, 'schema_version': version})
+
     """
     @TODO:
     Create an endpoint to handle GET requests
     for all available categories.
     """
     @app.route('/api/v1/categories')
+    @read_only
+    @conditional
     def retrieve_categories():
         # `GET '/api/v1/categories'`
 
@@ -70,19 +228,62 @@ def create_app(test_config=None):
         }
         '''
 
-        categories = Category.query.all()
-        categories_dict = {}
+        # the categories fragment is serialized once per registry version,
+        # and read together with the dict it was made from
+        categories, categories_json = category_registry.as_dict_and_json()
 
         # condition to check if there are categories
-        if categories is None:
+        if not categories:
             return not_found(404)
 
-        for category in categories:
-            categories_dict[category.id] = category.type
+        return app.response_class(
+            '{"categories":%s,"success":true}\n' % categories_json,
+            mimetype='application/json')
+
+    @app.route('/api/v1/stats')
+    @read_only
+    @conditional
+    def retrieve_stats():
+        # `GET '/api/v1/stats'`
+
+        # - Fetches the number of questions per category and difficulty
+        # - Request Arguments: None
+        # - Returns: the total number of questions and, per category id, the category type, its total and its questions per difficulty. Questions without a category are counted under "0".
+        '''json
+        {
+            "categories": {
+                "1": {
+                    "difficulty": {"1": 1, "2": 1, "4": 1},
+                    "total": 3,
+                    "type": "Science"
+                }
+            },
+            "success": true,
+            "total_questions": 3
+        }
+        '''
+
+        # the counts are read from question_stats, which every question
+        # write keeps up to date, instead of scanning questions
+        category_types = category_registry.as_dict()
+        categories = {}
+        total_questions = 0
+        for category, difficulty, count in question_stats.all():
+            stats = categories.setdefault(str(category), {
+                'type': category_types.get(category),
+                'total': 0,
+                'difficulty': {}
+            })
+            stats['total'] += count
+            stats['difficulty'][str(difficulty)] = count
+            total_questions += count
+
         return jsonify({
             'success': True,
-            'categories': categories_dict
+            'total_questions': total_questions,
+            'categories': categories
         })
+
     """
     @TODO:
     Create an endpoint to handle GET requests for questions,
@@ -97,13 +298,17 @@ def create_app(test_config=None):
     """
 
     @app.route('/api/v1/questions', methods=['GET'])
+    @read_only
+    @conditional
+    @cached(response_cache)
     def retrieve_questions():
 
         # `GET '/api/v1/questions'`
 
         # - Fetches a list of dictionaries of questions, answers, category_ids and a dictionary of categories in which the keys are the ids and the value is the corresponding string of the category
-        # - Request Arguments: None
+        # - Request Arguments: `page` (1-based page number) or `after_id` (keyset cursor: return the questions after this id)
         # - Returns: An object with three keys, `categories`, `current_category` and  `questions`, that contains an object of `id: category_string` key: value pairs, `current_category` and `questions list of categories``.
+        # - With `ids` (comma separated, at most `MAX_MULTI_GET_IDS`, default 100), fetches exactly those questions instead: `questions` in the order the ids were given and `missing`, the ids that do not exist, e.g. `{"missing": [99], "questions": [...], "success": true}`.
         '''json
         {
             "categories": {
@@ -115,6 +320,7 @@ def create_app(test_config=None):
                 "6": "Sports"
             },
             "current_category": null,
+            "next_after_id": null,
             "questions": [
                 {
                     "answer": "Edward Scissorhands",
@@ -129,30 +335,51 @@ def create_app(test_config=None):
         }
         '''
 
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
-        categories = Category.query.all()
-        categories_dict = {}
+        if 'ids' in request.args:
+            return retrieve_questions_by_ids(request.args['ids'])
+
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            current_questions = paginate_snapshot(request, snapshot)
+            total_questions = snapshot.total
+            categories = snapshot.categories
+        else:
+            current_questions = paginate_questions(request, question_rows())
+            total_questions = question_counts.total()
+            categories = category_registry.as_dict()
 
         # condition to check if the server has any questions
         if len(current_questions) == 0:
             return not_found(404)
 
-        # condition to check if the server is running
-        if selection is None:
-            return server_error(500)
-
-        # condition to check if the server has any categories
-        if categories is None:
-            return not_found(404)
-        for category in categories:
-            categories_dict[category.id] = category.type
         return jsonify({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(Question.query.all()),
-            'categories': categories_dict,
+            'total_questions': total_questions,
+            'categories': categories,
             'current_category': None,
+            'next_after_id': next_cursor(current_questions),
+        })
+
+    def retrieve_questions_by_ids(ids):
+        # one IN query for all of the requested ids
+        try:
+            ids = [int(question_id) for question_id in ids.split(',')]
+        except ValueError:
+            return bad_request(400)
+        # duplicates are returned once, at their first position
+        ids = list(dict.fromkeys(ids))
+        if not ids or len(ids) > MAX_MULTI_GET_IDS:
+            return bad_request(400)
+
+        questions = {question.id: question for question in
+                     Question.query.filter(Question.id.in_(ids)).all()}
+        return jsonify({
+            'success': True,
+            'questions': [questions[question_id].format()
+                          for question_id in ids if question_id in questions],
+            'missing': [question_id for question_id in ids
+                        if question_id not in questions]
         })
 
     """
@@ -169,7 +396,7 @@ def create_app(test_config=None):
         # `DELETE '/api/v1/questions/<int:question_id>'`
 
         # - Delete the question from the database
-        # - Request Arguments: None
+        # - Request Arguments: None. With a `Prefer: return=minimal` header (or `?fields=deleted`) only `success`, `deleted` and `message` are returned and the questions are not re-listed.
         # - Returns: An object with with a key of deleted and a value of the deleted question_id, and a key of message with the successfull deletion and updates the list of questions otherwise it will error 404 if the question_id is not found
         '''json
         {
@@ -196,8 +423,14 @@ def create_app(test_config=None):
             if question is None:
                 return not_found(404)
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            response_cache.clear()
+            if wants_minimal_response(request):
+                return minimal_response({
+                    'success': True,
+                    'deleted': question_id,
+                    'message': 'Question deleted successfully.'
+                })
+            current_questions = paginate_questions(request, question_rows())
 
             return jsonify({
                 'success': True,
@@ -205,7 +438,7 @@ def create_app(test_config=None):
                 'deleted': question_id,
                 'message': 'Question deleted successfully.',
                 'questions': current_questions,
-                'total_questions': len(Question.query.all())
+                'total_questions': question_counts.total()
             })
         except:
             return unprocessable(422)
@@ -226,19 +459,23 @@ def create_app(test_config=None):
         # `POST '/api/v1/questions'`
 
         # - Creates a new question and save it to the database
-        # - Request Arguments: none
-        # - Returns: An object with a single key, `categories`, that contains an object of `id: category_string` key: value pairs.
+        # - Request Arguments: `question`, `answer`, `category` and `difficulty`. With a `Prefer: return=minimal` header (or `?fields=created`) only `success`, `created` and `message` are returned and the questions are not re-listed.
+        # - Returns: The id of the created question, the first page of questions and the total number of questions.
         '''json
         {
-            "categories": {
-                "1": "Science",
-                "2": "Art",
-                "3": "Geography",
-                "4": "History",
-                "5": "Entertainment",
-                "6": "Sports"
-            },
-            "success": true
+            "created": 24,
+            "message": "Question created successfully.",
+            "questions": [
+                {
+                    "answer": "Edward Scissorhands",
+                    "category": 5,
+                    "difficulty": 3,
+                    "id": 6,
+                    "question": "What was the title of the 1990 fantasy directed by Tim Burton about a young man with multi-bladed appendages?"
+                }
+            ],
+            "success": true,
+            "total_questions": 20
         }
         '''
 
@@ -254,19 +491,140 @@ def create_app(test_config=None):
             question = Question(question=new_question, answer=new_answer,
                                 difficulty=new_difficulty, category=new_category)
             question.insert()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            response_cache.clear()
+            if wants_minimal_response(request):
+                return minimal_response({
+                    'success': True,
+                    'created': question.id,
+                    'message': 'Question created successfully.'
+                })
+            current_questions = paginate_questions(request, question_rows())
 
             return jsonify({
                 'success': True,
                 'created': question.id,
                 'message': 'Question created successfully.',
                 'questions': current_questions,
-                'total_questions': len(Question.query.all())
+                'total_questions': question_counts.total()
             })
         except:
             return unprocessable(422)
 
+    @app.route('/api/v1/questions/import', methods=['POST'])
+    def bulk_import_questions():
+
+        # `POST '/api/v1/questions/import'`
+
+        # - Imports many questions at once. The request body is streamed as NDJSON (one question object per line) or, with `Content-Type: text/csv` or `?format=csv`, as CSV with a `question,answer,category,difficulty` header. Rows are validated against the categories and inserted in batches.
+        # - Request Arguments: optional `format` (`ndjson` or `csv`) and `batch_size`
+        # - Returns: The number of imported and rejected rows, the errors of the first 100 rejected rows and the throughput. If the database rejects a batch, the import stops there with a 422 whose body is the same summary plus `aborted`: the `first_line`, `last_line` and `error` of that batch, which was not imported, and nothing after it was read; the batches before it stay imported.
+        '''json
+        {
+            "elapsed_seconds": 0.042,
+            "errors": [
+                {
+                    "error": "unknown category 12",
+                    "line": 3
+                }
+            ],
+            "failed": 1,
+            "imported": 2,
+            "rows_per_second": 48,
+            "success": true
+        }
+        '''
+
+        format = request.args.get('format')
+        if format is None:
+            format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        if format not in ('ndjson', 'csv'):
+            return bad_request(400)
+        batch_size = max(request.args.get(
+            'batch_size', IMPORT_BATCH_SIZE, type=int), 1)
+
+        lines = (line.decode('utf-8') for line in request.stream)
+        try:
+            summary = import_questions(lines, format, batch_size)
+        except (UnicodeDecodeError, csv.Error):
+            return bad_request(400)
+        finally:
+            response_cache.clear()
+
+        # a batch the database rejected: what was imported before it, and
+        # which lines to send again
+        if 'aborted' in summary:
+            summary.update({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable'
+            })
+            return jsonify(summary), 422
+
+        summary['success'] = True
+        return jsonify(summary)
+
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Create the database tables and apply the pending migrations."""
+        applied = create_schema(db.engine)
+        for migration in applied:
+            click.echo('applied migration {}'.format(migration))
+        if not applied:
+            click.echo('the database schema is up to date')
+
+    @app.cli.command('import-questions')
+    @click.argument('source', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(['ndjson', 'csv']),
+                  help='Input format, by default taken from the file extension.')
+    @click.option('--batch-size', default=IMPORT_BATCH_SIZE,
+                  help='Rows per INSERT and transaction.')
+    def import_questions_command(source, format, batch_size):
+        """Import questions from an NDJSON or CSV file ('-' for stdin)."""
+        if format is None:
+            format = 'csv' if source.name.endswith('.csv') else 'ndjson'
+        summary = import_questions(source, format, max(batch_size, 1))
+        for error in summary['errors']:
+            click.echo('line {line}: {error}'.format(**error), err=True)
+        click.echo('imported {imported}, failed {failed} in '
+                   '{elapsed_seconds}s ({rows_per_second} rows/s)'
+                   .format(**summary))
+        if 'aborted' in summary:
+            raise click.ClickException(
+                'aborted at lines {first_line}-{last_line}, which were not '
+                'imported, nor was anything after them: {error}'.format(
+                    **summary['aborted']))
+
+    @app.route('/api/v1/questions/export')
+    @read_only
+    def bulk_export_questions():
+
+        # `GET '/api/v1/questions/export'`
+
+        # - Streams every question as NDJSON, one question object per line, in id order
+        # - Request Arguments: optional `category` to export a single category and `after_id` to resume an interrupted export after the last id received
+        # - Returns: `application/x-ndjson` lines such as `{"id": 6, "question": "...", "answer": "Edward Scissorhands", "category": 5, "difficulty": 3}`
+
+        category = request.args.get('category', None, type=int)
+        if category is not None and category not in category_registry:
+            return not_found(404)
+        after_id = request.args.get('after_id', None, type=int)
+
+        return Response(
+            stream_with_context(export_questions(category, after_id)),
+            mimetype='application/x-ndjson')
+
+    @app.cli.command('export-questions')
+    @click.argument('target', type=click.File('w', encoding='utf-8'),
+                    default='-')
+    @click.option('--category', type=int,
+                  help='Only export the questions of this category.')
+    @click.option('--after-id', type=int,
+                  help='Resume after this question id.')
+    def export_questions_command(target, category, after_id):
+        """Export questions as NDJSON to a file (stdout by default)."""
+        for line in export_questions(category, after_id):
+            target.write(line)
+
     """
     @TODO:
     Create a POST endpoint to get questions based on a search term.
@@ -278,41 +636,63 @@ def create_app(test_config=None):
     Try using the word "title" to start.
     """
     @app.route('/api/v1/questions/search', methods=['POST'])
+    @read_only
     def search_questions():
 
-        # `GET '/api/v1/questions/search'`
+        # `POST '/api/v1/questions/search'`
 
-        # - Queries the database searching for a question based on the search term.
-        # - Request Arguments: None
-        # - Returns: Returns a list of questions that matches the search term.
+        # - Searches the questions for the search term. Every word of the term has to match the start of a word in the question, and results are ranked by relevance.
+        # - Request Arguments: `searchTerm`, optional `page` (default 1) and `limit` (default 10, at most 100), in the body or the query string
+        # - Returns: One page of matching questions and `total_questions`, the number of questions matching the search term.
+        '''json
+        {
+            "categories": {
+                "1": "Science",
+                "2": "Art",
+                "3": "Geography",
+                "4": "History",
+                "5": "Entertainment",
+                "6": "Sports"
+            },
+            "current_category": null,
+            "questions": [
+                {
+                    "answer": "Edward Scissorhands",
+                    "category": 5,
+                    "difficulty": 3,
+                    "id": 6,
+                    "question": "What was the title of the 1990 fantasy directed by Tim Burton about a young man with multi-bladed appendages?"
+                }
+            ],
+            "success": true,
+            "total_questions": 2
+        }
+        '''
 
-        body = request.get_json()
+        body = request.get_json(silent=True) or {}
         search_term = body.get('searchTerm', None)
 
-        # current_questions = paginate_questions(request, selection)
-        categories = Category.query.all()
-        categories_dict = {}
-
-        if categories is None:
-            return not_found(404)
-
-        if search_term == '':
+        if not search_term:
             return bad_request(400)
 
-        for category in categories:
-            categories_dict[category.id] = category.type
+        try:
+            page = max(int(body.get('page', request.args.get('page', 1))), 1)
+            limit = int(body.get('limit', request.args.get(
+                'limit', QUESTIONS_PER_PAGE)))
+        except (TypeError, ValueError):
+            return bad_request(400)
+        limit = min(max(limit, 1), MAX_SEARCH_RESULTS_PER_PAGE)
 
-        if search_term:
-            search_result = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
+        search_result, total = question_search.search(
+            search_term, offset=(page - 1) * limit, limit=limit)
 
-            return jsonify({
-                'success': True,
-                'questions': [question.format() for question in search_result],
-                'total_questions': len(Question.query.all()),
-                'categories': categories_dict,
-                'current_category': None
-            })
+        return jsonify({
+            'success': True,
+            'questions': [question.format() for question in search_result],
+            'total_questions': total,
+            'categories': category_registry.as_dict(),
+            'current_category': None
+        })
 
     """
     @TODO:
@@ -324,12 +704,15 @@ def create_app(test_config=None):
     """
 
     @app.route('/api/v1/categories/<int:category_id>/questions')
+    @read_only
+    @conditional
+    @cached(response_cache)
     def retrieve_questions_by_category(category_id):
 
         # `POST '/api/v1/categories/<int:category_id>/questions'`
 
         # - Gets questions based on category_id
-        # - Request Arguments: none
+        # - Request Arguments: `page` or `after_id`, as for `GET '/api/v1/questions'`
         # - Returns: A list of questions in the specified category.
         '''json
         {
@@ -342,6 +725,7 @@ def create_app(test_config=None):
                 "6": "Sports"
             },
             "current_category": 5,
+            "next_after_id": null,
             "questions": [
                 {
                     "answer": "Edward Scissorhands",
@@ -356,26 +740,33 @@ def create_app(test_config=None):
         }
         '''
 
-        selection = Question.query.filter(
-            Question.category == category_id).all()
-        current_questions = paginate_questions(request, selection)
-        categories = Category.query.all()
-        categories_dict = {}
+        # unknown categories return the 404 errorhandler
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            categories = snapshot.categories
+            total_questions = snapshot.category_total(category_id)
+        else:
+            categories = category_registry.as_dict()
+            total_questions = question_counts.for_category(category_id)
 
-        # if category_id is greater than length of categories return 404 errorhandler
-        if category_id > len(categories):
+        if category_id not in categories:
             return not_found(404)
 
-        if categories is None:
-            return not_found(404)
-        for category in categories:
-            categories_dict[category.id] = category.type
+        if snapshot is not None:
+            current_questions = paginate_snapshot(
+                request, snapshot, category_id)
+        else:
+            selection = question_rows().filter(
+                Question.category == category_id)
+            current_questions = paginate_questions(request, selection)
+
         return jsonify({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(Question.query.all()),
-            'categories': categories_dict,
-            'current_category': category_id
+            'total_questions': total_questions,
+            'categories': categories,
+            'current_category': category_id,
+            'next_after_id': next_cursor(current_questions)
         })
 
     """
@@ -390,15 +781,16 @@ def create_app(test_config=None):
     and shown whether they were correct or not.
     """
     @app.route('/api/v1/quizzes', methods=['POST'])
+    @read_only
     def play_quiz():
 
-        # `GET '/api/v1/questions'`
+        # `POST '/api/v1/quizzes'`
 
         # - Fetches one question at a time from selected category or all questions
-        # - Request Arguments: None
-        # - Returns:One question at a time is displayed, the user is allowed to answer
+        # - Request Arguments: `quiz_category` (`{"id": 0}` for all categories) and `previous_questions`, the ids already played. Optional `count` (at most 50) prefetches that many distinct questions at once.
+        # - Returns:One question at a time is displayed, the user is allowed to answer. With `count`, a `questions` list of up to `count` questions is returned instead of `question`.
 
-        body = request.get_json()
+        body = request.get_json(silent=True) or {}
 
         if not ('quiz_category' in body and 'previous_questions' in body):
             return unprocessable(422)
@@ -406,29 +798,163 @@ def create_app(test_config=None):
         previous_questions = body.get('previous_questions')
         quiz_category = body.get('quiz_category')
 
+        count = body.get('count')
+        if count is not None:
+            try:
+                count = min(max(int(count), 1), MAX_QUIZ_BATCH)
+            except (TypeError, ValueError):
+                return unprocessable(422)
+
         try:
-            if quiz_category['id'] == 0:
-                selection = Question.query.filter(
-                    Question.id.notin_(previous_questions)).all()
-            else:
-                selection = Question.query.filter(
-                    Question.category == quiz_category['id'],
-                    Question.id.notin_(previous_questions)).all()
-            if len(selection) == 0:
+            category = quiz_category['id']
+            if category == 0:
+                category = None
+
+            snapshot = current_snapshot()
+            if snapshot is not None:
+                # drawn and read from the shared snapshot, no query
+                questions = [snapshot.get(question_id) for question_id in
+                             snapshot.sample_many(count or 1, category,
+                                                  previous_questions)]
+                if count is not None:
+                    return jsonify({'success': True, 'questions': questions})
                 return jsonify({
                     'success': True,
-                    'question': None
+                    'question': questions[0] if questions else None
                 })
-            else:
-                random_question = selection[random.randrange(
-                    0, len(selection))].format()
+
+            if count is not None:
+                chosen = question_ids.sample_many(
+                    count, category, previous_questions)
+                # one IN query for the whole batch, returned in draw order
+                questions = {question.id: question for question in
+                             Question.query.filter(
+                                 Question.id.in_(chosen)).all()} \
+                    if chosen else {}
                 return jsonify({
                     'success': True,
-                    'question': random_question
+                    'questions': [questions[question_id].format()
+                                  for question_id in chosen
+                                  if question_id in questions]
                 })
+
+            # the id is drawn from the in-memory id index; only the chosen
+            # row is loaded
+            question = None
+            question_id = question_ids.sample(category, previous_questions)
+            if question_id is not None:
+                question = Question.query.get(question_id)
+                if question is None:
+                    # deleted by another worker: reload the ids and redraw
+                    question_ids.invalidate()
+                    question_id = question_ids.sample(
+                        category, previous_questions)
+                    if question_id is not None:
+                        question = Question.query.get(question_id)
+            return jsonify({
+                'success': True,
+                'question': question.format() if question else None
+            })
         except:
             return server_error(500)
 
+    @app.route('/api/v1/quizzes/sessions', methods=['POST'])
+    @read_only
+    def create_quiz_session():
+
+        # `POST '/api/v1/quizzes/sessions'`
+
+        # - Starts a quiz: the eligible question ids are shuffled once on the server and kept in a session, so the client does not have to resend `previous_questions`. Sessions are held in the memory of the worker that created them: with several workers, run one worker or route a session's requests to the same worker (sticky routing), or `/next` returns 404 on the others.
+        # - Request Arguments: `quiz_category` (`{"id": 0}` for all categories)
+        # - Returns: The session token and the number of questions in the quiz.
+        '''json
+        {
+            "quiz_category": 5,
+            "remaining": 3,
+            "session_id": "mBv0a6bdS1EeDm5Pc5Jx3w",
+            "success": true,
+            "total_questions": 3
+        }
+        '''
+
+        body = request.get_json(silent=True) or {}
+        quiz_category = body.get('quiz_category')
+
+        try:
+            category = int(quiz_category['id'])
+        except (KeyError, TypeError, ValueError):
+            return unprocessable(422)
+
+        if category != 0 and category not in category_registry:
+            return not_found(404)
+
+        token, session = quiz_sessions.create(
+            category, question_ids.ids(category or None))
+        response = session.format()
+        response.update({'success': True, 'session_id': token})
+        return jsonify(response)
+
+    @app.route('/api/v1/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @read_only
+    def next_quiz_question(session_id):
+
+        # `POST '/api/v1/quizzes/sessions/<session_id>/next'`
+
+        # - Fetches the next question of a quiz session
+        # - Request Arguments: None
+        # - Returns: The next question, or `null` once the quiz is over, and the number of questions left. Unknown or expired sessions return 404.
+        '''json
+        {
+            "question": {
+                "answer": "Edward Scissorhands",
+                "category": 5,
+                "difficulty": 3,
+                "id": 6,
+                "question": "What was the title of the 1990 fantasy directed by Tim Burton about a young man with multi-bladed appendages?"
+            },
+            "quiz_category": 5,
+            "remaining": 2,
+            "success": true,
+            "total_questions": 3
+        }
+        '''
+
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            return not_found(404)
+
+        question = None
+        question_id = session.next_id()
+        while question_id is not None:
+            question = Question.query.get(question_id)
+            if question is not None:
+                break
+            # deleted since the deck was dealt
+            question_id = session.next_id()
+
+        response = session.format()
+        response.update({
+            'success': True,
+            'question': question.format() if question else None
+        })
+        return jsonify(response)
+
+    @app.route('/api/v1/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def end_quiz_session(session_id):
+
+        # `DELETE '/api/v1/quizzes/sessions/<session_id>'`
+
+        # - Ends a quiz session before its deck is used up
+        # - Request Arguments: None
+        # - Returns: An object with a key of deleted and the session id, or 404 for unknown sessions.
+
+        if not quiz_sessions.discard(session_id):
+            return not_found(404)
+        return jsonify({
+            'success': True,
+            'deleted': session_id
+        })
+
     """
     @TODO:
     Create error handlers for all expected errors
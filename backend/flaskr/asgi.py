@@ -0,0 +1,514 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from sqlalchemy import bindparam, func, select, text
+from sqlalchemy.dialects.postgresql.base import PGCompiler, PGDialect
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from models import Question, Category, QUESTION_COLUMNS, QUESTION_TSVECTOR, \
+    DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_STATEMENT_TIMEOUT, \
+    DATA_VERSION_TTL, question_ids, question_stats_table, data_version_table, \
+    format_row, tokenize
+from . import QUESTIONS_PER_PAGE, MAX_SEARCH_RESULTS_PER_PAGE, \
+    MAX_QUIZ_BATCH, MAX_MULTI_GET_IDS, next_cursor
+from .encoding import dumps
+
+"""
+Async read-only API
+
+An ASGI application serving the read endpoints of the Flask app
+(categories, question list, category filter, search and quizzes) with
+the same response bodies. Queries go through an asyncpg connection pool,
+so a request only holds a database connection while a statement runs
+and one process can keep thousands of idle client connections open:
+
+    pip install asyncpg uvicorn
+    uvicorn flaskr.asgi:app
+
+Writes, bulk import/export, quiz sessions and the metrics stay on the
+WSGI app; a proxy in front sends these read paths to this server.
+"""
+
+# the asyncpg pool: connections opened at startup and the most ever open
+ASYNC_DB_POOL_MIN = int(os.getenv('ASYNC_DB_POOL_MIN', '2'))
+ASYNC_DB_POOL_MAX = int(os.getenv('ASYNC_DB_POOL_MAX', '20'))
+ASYNC_DATABASE_URL = os.getenv(
+    'ASYNC_DATABASE_URL', 'postgresql://{}:{}@{}/{}'.format(
+        DB_USER, DB_PASSWORD, DB_HOST, DB_NAME))
+
+RESPONSE_HEADERS = [
+    (b'content-type', b'application/json'),
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers',
+     b'Content-Type, Authorization, Prefer, true'),
+    (b'access-control-allow-methods', b'GET, PUT, POST, DELETE, OPTIONS')
+]
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'internal server error'
+}
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncpgCompiler(PGCompiler):
+
+    def bindparam_string(self, name, **kw):
+        # asyncpg numbers its parameters: $1, $2, ...
+        return '$' + super().bindparam_string(name, **kw)[1:]
+
+
+class AsyncpgDialect(PGDialect):
+    statement_compiler = AsyncpgCompiler
+
+
+DIALECT = AsyncpgDialect(paramstyle='numeric')
+
+
+"""
+Statement
+    a SQLAlchemy Core statement compiled once for asyncpg: its SQL, and the
+    order and default values of its parameters
+"""
+
+
+class Statement:
+
+    def __init__(self, statement):
+        compiled = statement.compile(dialect=DIALECT)
+        self.sql = compiled.string
+        self.names = compiled.positiontup
+        self.defaults = compiled.params
+
+    def args(self, **params):
+        return [params[name] if name in params else self.defaults[name]
+                for name in self.names]
+
+    async def fetch(self, connection, **params):
+        return await connection.fetch(self.sql, *self.args(**params))
+
+    async def fetchval(self, connection, **params):
+        return await connection.fetchval(self.sql, *self.args(**params))
+
+
+def question_page(category, after_id):
+    selection = select(QUESTION_COLUMNS)
+    if category:
+        selection = selection.where(
+            Question.category == bindparam('category'))
+    if after_id:
+        selection = selection.where(Question.id > bindparam('after_id'))
+    return Statement(selection.order_by(Question.id)
+                     .offset(bindparam('offset')).limit(bindparam('limit')))
+
+
+SEARCH_MATCH = text("{} @@ to_tsquery('simple', :query)"
+                    .format(QUESTION_TSVECTOR))
+SEARCH_RANK = text("ts_rank({}, to_tsquery('simple', :query)) DESC"
+                   .format(QUESTION_TSVECTOR))
+
+SELECT_DATA_VERSION = Statement(select([data_version_table.c.version]))
+SELECT_CATEGORIES = Statement(
+    select([Category.id, Category.type]).order_by(Category.id))
+# question_stats is kept exact by every write, see QuestionStats
+SELECT_QUESTION_COUNTS = Statement(
+    select([question_stats_table.c.category,
+            func.sum(question_stats_table.c.count)])
+    .group_by(question_stats_table.c.category))
+SELECT_QUESTION_PAGES = {
+    (category, after_id): question_page(category, after_id)
+    for category in (False, True) for after_id in (False, True)}
+SELECT_QUESTIONS_BY_IDS = Statement(
+    select(QUESTION_COLUMNS).where(Question.id == func.any(bindparam('ids'))))
+SELECT_QUESTION_IDS = Statement(
+    select([Question.id, Question.category]).order_by(Question.id))
+COUNT_SEARCH_MATCHES = Statement(
+    select([func.count(Question.id)]).where(SEARCH_MATCH))
+SELECT_SEARCH_PAGE = Statement(
+    select(QUESTION_COLUMNS).where(SEARCH_MATCH)
+    .order_by(SEARCH_RANK, Question.id)
+    .offset(bindparam('offset')).limit(bindparam('limit')))
+
+
+def int_arg(args, name, default=None):
+    # like request.args.get(name, default, type=int)
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def error(status):
+    return status, {
+        'success': False,
+        'error': status,
+        'message': ERROR_MESSAGES[status]
+    }
+
+
+"""
+Request
+    what a handler gets of an ASGI http request: the method, the path,
+    the first value of every query argument and the JSON body
+"""
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {name: values[0] for name, values in parse_qs(
+            scope.get('query_string', b'').decode('latin-1')).items()}
+        self.body = body
+
+    def get_json(self):
+        # like request.get_json(silent=True)
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+
+"""
+AsyncReadAPI
+    the ASGI application; the pool is opened on lifespan startup, or by
+    the first request when the server does not send lifespan events
+"""
+
+
+class AsyncReadAPI:
+
+    def __init__(self, dsn=ASYNC_DATABASE_URL, min_size=ASYNC_DB_POOL_MIN,
+                 max_size=ASYNC_DB_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._opening = None
+        # created on first use, inside the server's event loop
+        self._id_lock = None
+        self._id_loads = 0
+        # the data version, read at most every DATA_VERSION_TTL seconds,
+        # and the categories and question totals loaded at a version
+        self._version = None
+        self._version_read_at = 0
+        self._categories = (None, None)
+        self._counts = (None, None)
+        self.routes = [
+            ('GET', re.compile(r'/api/v1/categories$'),
+             self.retrieve_categories),
+            ('GET', re.compile(r'/api/v1/questions$'),
+             self.retrieve_questions),
+            ('GET', re.compile(r'/api/v1/categories/(\d+)/questions$'),
+             self.retrieve_questions_by_category),
+            ('POST', re.compile(r'/api/v1/questions/search$'),
+             self.search_questions),
+            ('POST', re.compile(r'/api/v1/quizzes$'), self.play_quiz)
+        ]
+
+    async def open(self):
+        if self.pool is not None:
+            return self.pool
+        if asyncpg is None:
+            raise RuntimeError('the async API needs asyncpg: '
+                               'pip install asyncpg')
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size,
+                server_settings={
+                    'statement_timeout': str(DB_STATEMENT_TIMEOUT)}))
+        self.pool = await self._opening
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+        self.pool = None
+        self._opening = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.open()
+                except Exception as exception:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(exception)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+
+        if request.method == 'OPTIONS':
+            await self.respond(send, 200, None)
+            return
+        status, response = await self.dispatch(request)
+        await self.respond(send, status, response)
+
+    async def dispatch(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            try:
+                pool = await self.open()
+                async with pool.acquire() as connection:
+                    return await handler(connection, request,
+                                         *match.groups())
+            except Exception:
+                logger.exception('%s %s failed', request.method,
+                                 request.path)
+                return error(500)
+        return error(405 if allowed else 404)
+
+    async def respond(self, send, status, response):
+        body = dumps(response) if response is not None else b''
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': RESPONSE_HEADERS +
+                    [(b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def data_version(self, connection):
+        # like DataVersion.current(): cached, so most requests skip it
+        if self._version is None or \
+                time.monotonic() - self._version_read_at >= DATA_VERSION_TTL:
+            self._version = await SELECT_DATA_VERSION.fetchval(connection)
+            self._version_read_at = time.monotonic()
+        return self._version
+
+    async def categories(self, connection):
+        # served from memory until the data version moves, like
+        # category_registry
+        version = await self.data_version(connection)
+        loaded_at, categories = self._categories
+        if categories is None or loaded_at != version:
+            categories = {id: type for id, type in
+                          await SELECT_CATEGORIES.fetch(connection)}
+            self._categories = (version, categories)
+        return categories
+
+    async def question_counts(self, connection):
+        # like question_counts, from question_stats once per data version
+        version = await self.data_version(connection)
+        loaded_at, counts = self._counts
+        if counts is None or loaded_at != version:
+            counts = {category: count for category, count in
+                      await SELECT_QUESTION_COUNTS.fetch(connection)}
+            self._counts = (version, counts)
+        return counts
+
+    async def load_question_ids(self, connection, force=False):
+        """reloads the shared id index when it is stale or, with `force`,
+        unless another request reloaded it meanwhile. One request scans
+        the table while the others wait for it on the lock"""
+        loads = self._id_loads
+        if self._id_lock is None:
+            self._id_lock = asyncio.Lock()
+        async with self._id_lock:
+            if question_ids.stale or (force and self._id_loads == loads):
+                question_ids.load(await SELECT_QUESTION_IDS.fetch(connection))
+                self._id_loads += 1
+
+    async def question_page(self, connection, request, category=None):
+        # the same pages as paginate_questions()
+        after_id = int_arg(request.args, 'after_id')
+        offset = 0
+        if after_id is None:
+            page = max(int_arg(request.args, 'page', 1), 1)
+            offset = (page - 1) * QUESTIONS_PER_PAGE
+        statement = SELECT_QUESTION_PAGES[
+            (category is not None, after_id is not None)]
+        rows = await statement.fetch(
+            connection, category=category, after_id=after_id, offset=offset,
+            limit=QUESTIONS_PER_PAGE)
+        return [format_row(row) for row in rows]
+
+    async def questions_by_ids(self, connection, ids):
+        rows = await SELECT_QUESTIONS_BY_IDS.fetch(connection, ids=ids)
+        return {row[0]: format_row(row) for row in rows}
+
+    async def retrieve_categories(self, connection, request):
+        categories = await self.categories(connection)
+        if not categories:
+            return error(404)
+        return 200, {'success': True, 'categories': categories}
+
+    async def retrieve_questions(self, connection, request):
+        if 'ids' in request.args:
+            return await self.retrieve_questions_by_ids(
+                connection, request.args['ids'])
+
+        current_questions = await self.question_page(connection, request)
+        if len(current_questions) == 0:
+            return error(404)
+
+        counts = await self.question_counts(connection)
+        return 200, {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': sum(counts.values()),
+            'categories': await self.categories(connection),
+            'current_category': None,
+            'next_after_id': next_cursor(current_questions)
+        }
+
+    async def retrieve_questions_by_ids(self, connection, ids):
+        try:
+            ids = [int(question_id) for question_id in ids.split(',')]
+        except ValueError:
+            return error(400)
+        ids = list(dict.fromkeys(ids))
+        if not ids or len(ids) > MAX_MULTI_GET_IDS:
+            return error(400)
+
+        questions = await self.questions_by_ids(connection, ids)
+        return 200, {
+            'success': True,
+            'questions': [questions[question_id] for question_id in ids
+                          if question_id in questions],
+            'missing': [question_id for question_id in ids
+                        if question_id not in questions]
+        }
+
+    async def retrieve_questions_by_category(self, connection, request,
+                                             category_id):
+        category_id = int(category_id)
+        categories = await self.categories(connection)
+        if category_id not in categories:
+            return error(404)
+
+        current_questions = await self.question_page(
+            connection, request, category_id)
+        counts = await self.question_counts(connection)
+        return 200, {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': counts.get(category_id, 0),
+            'categories': categories,
+            'current_category': category_id,
+            'next_after_id': next_cursor(current_questions)
+        }
+
+    async def search_questions(self, connection, request):
+        body = request.get_json()
+        if not isinstance(body, dict):
+            body = {}
+        search_term = body.get('searchTerm', None)
+        if not search_term:
+            return error(400)
+
+        try:
+            page = max(int(body.get('page', request.args.get('page', 1))), 1)
+            limit = int(body.get('limit', request.args.get(
+                'limit', QUESTIONS_PER_PAGE)))
+        except (TypeError, ValueError):
+            return error(400)
+        limit = min(max(limit, 1), MAX_SEARCH_RESULTS_PER_PAGE)
+
+        # the same prefix match and ranking as QuestionSearch on Postgres
+        questions, total = [], 0
+        tokens = tokenize(search_term)
+        if tokens:
+            query = ' & '.join(token + ':*' for token in tokens)
+            total = await COUNT_SEARCH_MATCHES.fetchval(
+                connection, query=query)
+            rows = await SELECT_SEARCH_PAGE.fetch(
+                connection, query=query, offset=(page - 1) * limit,
+                limit=limit)
+            questions = [format_row(row) for row in rows]
+
+        return 200, {
+            'success': True,
+            'questions': questions,
+            'total_questions': total,
+            'categories': await self.categories(connection),
+            'current_category': None
+        }
+
+    async def play_quiz(self, connection, request):
+        body = request.get_json()
+        if not isinstance(body, dict):
+            body = {}
+        if not ('quiz_category' in body and 'previous_questions' in body):
+            return error(422)
+
+        previous_questions = body.get('previous_questions')
+        quiz_category = body.get('quiz_category')
+
+        count = body.get('count')
+        if count is not None:
+            try:
+                count = min(max(int(count), 1), MAX_QUIZ_BATCH)
+            except (TypeError, ValueError):
+                return error(422)
+
+        try:
+            category = quiz_category['id']
+        except (KeyError, TypeError):
+            return error(500)
+        if category == 0:
+            category = None
+
+        # ids are drawn from the shared in-memory id index, reloaded here
+        # through the pool once it is older than its TTL
+        if question_ids.stale:
+            await self.load_question_ids(connection)
+        chosen = question_ids.sample_many(
+            count or 1, category, previous_questions)
+        questions = await self.questions_by_ids(connection, chosen) \
+            if chosen else {}
+        if chosen and not questions:
+            # deleted since the index was loaded: reload it and redraw
+            await self.load_question_ids(connection, force=True)
+            chosen = question_ids.sample_many(
+                count or 1, category, previous_questions)
+            questions = await self.questions_by_ids(connection, chosen) \
+                if chosen else {}
+
+        if count is not None:
+            return 200, {
+                'success': True,
+                'questions': [questions[question_id]
+                              for question_id in chosen
+                              if question_id in questions]
+            }
+        question = questions.get(chosen[0]) if chosen else None
+        return 200, {'success': True, 'question': question}
+
+
+app = AsyncReadAPI()
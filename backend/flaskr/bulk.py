@@ -0,0 +1,174 @@
+import csv
+import json
+import os
+import time
+
+from models import db, Question, category_registry, questions_changed, \
+    question_rows, format_row, data_version, question_stats
+
+# rows sent to the database in one multi-row INSERT and one transaction
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+# per-row errors reported back; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+"""
+parse_rows(lines, format)
+    turns an iterable of text lines (NDJSON or CSV with a header row) into
+    (line_number, row) pairs without reading the whole input; a row that
+    cannot be parsed is yielded as (line_number, error message)
+"""
+
+
+def parse_rows(lines, format='ndjson'):
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, 'invalid JSON: {}'.format(error)
+            continue
+        if not isinstance(row, dict):
+            yield line_number, 'expected a JSON object'
+            continue
+        yield line_number, row
+
+
+"""
+validate_row(row)
+    returns the column values for a question row, or raises ValueError
+    describing the first problem found
+"""
+
+
+def validate_row(row):
+    values = {}
+    for field in ('question', 'answer'):
+        value = row.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('{} is required'.format(field))
+        values[field] = value
+
+    for field in ('category', 'difficulty'):
+        try:
+            values[field] = int(row.get(field))
+        except (TypeError, ValueError):
+            raise ValueError('{} must be an integer'.format(field))
+
+    if values['category'] not in category_registry:
+        raise ValueError('unknown category {}'.format(values['category']))
+    return values
+
+
+"""
+import_questions(lines, format, batch_size)
+    validates and inserts questions from a stream of NDJSON or CSV lines,
+    one multi-row INSERT per batch, and returns a summary with the
+    per-row errors and the throughput. A batch the database rejects is
+    rolled back and ends the import: the batches before it stay, and the
+    summary gets an `aborted` entry with the lines of that batch and why
+"""
+
+
+def import_questions(lines, format='ndjson', batch_size=IMPORT_BATCH_SIZE):
+    started = time.monotonic()
+    imported = 0
+    failed = 0
+    errors = []
+    aborted = None
+    batch = []
+    batch_lines = []
+
+    def flush():
+        if batch:
+            db.session.execute(Question.__table__.insert().values(batch))
+            data_version.bump()
+            deltas = {}
+            for row in batch:
+                key = (row['category'], row['difficulty'])
+                deltas[key] = deltas.get(key, 0) + 1
+            question_stats.add(db.session, deltas)
+            db.session.commit()
+        return len(batch)
+
+    def abort(error):
+        db.session.rollback()
+        # the DBAPI message, without the statement and its parameters
+        return {
+            'first_line': batch_lines[0],
+            'last_line': batch_lines[-1],
+            'error': str(getattr(error, 'orig', None) or error)
+        }
+
+    try:
+        for line_number, row in parse_rows(lines, format):
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError(row)
+                batch.append(validate_row(row))
+                batch_lines.append(line_number)
+            except ValueError as error:
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': line_number, 'error': str(error)})
+                continue
+            if len(batch) >= batch_size:
+                try:
+                    imported += flush()
+                except Exception as error:
+                    aborted = abort(error)
+                    break
+                batch = []
+                batch_lines = []
+        else:
+            try:
+                imported += flush()
+            except Exception as error:
+                aborted = abort(error)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if imported:
+            questions_changed()
+
+    elapsed = time.monotonic() - started
+    summary = {
+        'imported': imported,
+        'failed': failed,
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(imported / elapsed) if elapsed else imported
+    }
+    if aborted is not None:
+        summary['aborted'] = aborted
+    return summary
+
+
+"""
+export_questions(category, after_id, batch_size)
+    yields every question, optionally of one category, as an NDJSON line in
+    id order. Rows are fetched through a server-side cursor `batch_size`
+    at a time, so memory use does not depend on the size of the table;
+    an interrupted export is resumed by passing the last id received as
+    `after_id`
+"""
+
+
+def export_questions(category=None, after_id=None,
+                     batch_size=IMPORT_BATCH_SIZE):
+    selection = question_rows().execution_options(stream_results=True)
+    if category is not None:
+        selection = selection.filter(Question.category == category)
+    if after_id is not None:
+        selection = selection.filter(Question.id > after_id)
+
+    for row in selection.order_by(Question.id).yield_per(batch_size):
+        yield json.dumps(format_row(row)) + '\n'
@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+from models import data_version
+
+# bytes of response bodies the response cache may hold
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', str(16 << 20)))
+# rough per-entry overhead of the key and bookkeeping, in bytes
+CACHE_ENTRY_OVERHEAD = 200
+
+
+"""
+conditional(view)
+    answers conditional GETs for a view whose response only depends on the
+    request and the data version: the ETag is the data version, and a
+    client whose If-None-Match (or If-Modified-Since) is still current gets
+    a 304 without the view running
+"""
+
+
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = data_version.current()
+        etag = 'v{}'.format(version)
+        # Last-Modified only has whole seconds, which cannot tell apart
+        # writes within the second still running: until it is over, a date
+        # neither validates nor is handed out as one that could later
+        last_modified = updated_at.replace(microsecond=0)
+        settled = last_modified < datetime.utcnow().replace(microsecond=0)
+        if not settled:
+            last_modified -= timedelta(seconds=1)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            not_modified = settled and since is not None and \
+                last_modified <= since.replace(tzinfo=None)
+
+        if not_modified:
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    return wrapper
+
+
+"""
+ResponseCache
+    encoded response bodies by key, least recently used first out once
+    they take more than `max_bytes`
+"""
+
+
+class ResponseCache:
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        cost = len(body) + CACHE_ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous) + CACHE_ENTRY_OVERHEAD
+            self._entries[key] = body
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted) + CACHE_ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def render(self):
+        """the cache counters in the Prometheus text format"""
+        lines = []
+        for name, kind, value in (
+                ('trivia_response_cache_hits_total', 'counter', self.hits),
+                ('trivia_response_cache_misses_total', 'counter',
+                 self.misses),
+                ('trivia_response_cache_evictions_total', 'counter',
+                 self.evictions),
+                ('trivia_response_cache_entries', 'gauge',
+                 len(self._entries)),
+                ('trivia_response_cache_bytes', 'gauge', self.size)):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+"""
+cached(cache)
+    serves a view's successful responses from `cache`, keyed by endpoint,
+    URL arguments, query string and data version, so a write never serves
+    a stale page even before the cache is cleared
+"""
+
+
+def cached(cache):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version, _ = data_version.current()
+            key = (request.endpoint, tuple(sorted(kwargs.items())),
+                   request.query_string, version)
+            body = cache.get(key)
+            if body is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                cache.put(key, body)
+            return current_app.response_class(
+                body, mimetype='application/json')
+        return wrapper
+    return decorator
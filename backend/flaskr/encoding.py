@@ -0,0 +1,54 @@
+import json
+import os
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the JSON encoder used for every response: 'orjson' when it is installed,
+# otherwise the standard library; set JSON_ENCODER=stdlib to force the latter
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'orjson' if orjson else 'stdlib')
+
+
+"""
+dumps(value)
+    encodes a response body to bytes, compact and with sorted keys like
+    Flask's own jsonify
+"""
+
+
+def stdlib_dumps(value):
+    return (json.dumps(value, separators=(',', ':'), sort_keys=True) +
+            '\n').encode()
+
+
+def orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS |
+                        orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+
+ENCODERS = {'stdlib': stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = orjson_dumps
+
+dumps = ENCODERS.get(JSON_ENCODER, stdlib_dumps)
+
+
+"""
+jsonify(*args, **kwargs)
+    a drop-in for flask.jsonify that encodes with `dumps`
+"""
+
+
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() takes either arguments or keywords')
+    if len(args) == 1:
+        value = args[0]
+    else:
+        value = args or kwargs
+    return current_app.response_class(dumps(value),
+                                      mimetype='application/json')
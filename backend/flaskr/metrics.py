@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+# add a Server-Timing header with the SQL and total time to every response
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true')
+
+
+"""
+EndpointStats
+    what has been recorded for one endpoint: a latency histogram and the
+    SQL statements, SQL time and rows fetched by its requests
+"""
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.requests = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.sql_rows = 0
+
+    def record(self, seconds, sql_statements, sql_seconds, sql_rows):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        self.requests += 1
+        self.seconds += seconds
+        self.sql_statements += sql_statements
+        self.sql_seconds += sql_seconds
+        self.sql_rows += sql_rows
+
+
+"""
+Metrics
+    per-endpoint request statistics, rendered in the Prometheus text format
+"""
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, *values):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.record(*values)
+
+    def render(self):
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = [
+                '# HELP trivia_request_duration_seconds Request latency.',
+                '# TYPE trivia_request_duration_seconds histogram'
+            ]
+            for endpoint, stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(
+                        'trivia_request_duration_seconds_bucket'
+                        '{{endpoint="{}",le="{}"}} {}'.format(
+                            endpoint, bound, cumulative))
+                lines.append(
+                    'trivia_request_duration_seconds_bucket'
+                    '{{endpoint="{}",le="+Inf"}} {}'.format(
+                        endpoint, stats.requests))
+                lines.append('trivia_request_duration_seconds_sum'
+                             '{{endpoint="{}"}} {}'.format(
+                                 endpoint, stats.seconds))
+                lines.append('trivia_request_duration_seconds_count'
+                             '{{endpoint="{}"}} {}'.format(
+                                 endpoint, stats.requests))
+
+            for name, attribute, help in (
+                    ('trivia_sql_statements_total', 'sql_statements',
+                     'SQL statements executed.'),
+                    ('trivia_sql_duration_seconds_total', 'sql_seconds',
+                     'Time spent executing SQL.'),
+                    ('trivia_sql_rows_total', 'sql_rows',
+                     'Rows returned or changed, as reported by the driver.')):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} counter'.format(name))
+                for endpoint, stats in endpoints:
+                    lines.append('{}{{endpoint="{}"}} {}'.format(
+                        name, endpoint, getattr(stats, attribute)))
+        return '\n'.join(lines) + '\n'
+
+
+"""
+SQL statement hooks
+    count the statements, time and rows of the current request; they are
+    registered once on every engine and do nothing outside a request
+"""
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info['query_started'].pop()
+    if not has_app_context() or 'sql_statements' not in g:
+        return
+    g.sql_statements += 1
+    g.sql_seconds += time.perf_counter() - started
+    # -1 when the driver does not know, e.g. SQLite selects
+    g.sql_rows += max(cursor.rowcount, 0)
+
+
+"""
+setup_metrics(app)
+    records the latency and SQL use of every request of the app
+"""
+
+
+def setup_metrics(app):
+    app.config.setdefault('SERVER_TIMING', SERVER_TIMING)
+    metrics = Metrics()
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+        g.sql_rows = 0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_started' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_started
+        metrics.record(request.endpoint or 'unmatched', seconds,
+                       g.sql_statements, g.sql_seconds, g.sql_rows)
+        if app.config['SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing',
+                'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(
+                    g.sql_seconds * 1000, g.sql_statements, seconds * 1000))
+        return response
+
+    return metrics
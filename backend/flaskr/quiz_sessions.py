@@ -0,0 +1,92 @@
+import os
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# seconds a quiz session is kept after it was last used
+QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', '3600'))
+# sessions kept at most; the least recently used one is evicted first
+QUIZ_SESSION_MAX = int(os.getenv('QUIZ_SESSION_MAX', '10000'))
+
+
+"""
+QuizSession
+    a pre-shuffled deck of question ids for one quiz; the next question is
+    popped from the end of the deck
+"""
+
+
+class QuizSession:
+
+    def __init__(self, category, deck):
+        self.category = category
+        self.deck = deck
+        self.total = len(deck)
+        self.touched_at = time.monotonic()
+
+    def next_id(self):
+        return self.deck.pop() if self.deck else None
+
+    def format(self):
+        return {
+            'quiz_category': self.category,
+            'total_questions': self.total,
+            'remaining': len(self.deck)
+        }
+
+
+"""
+QuizSessionStore
+    quiz sessions by token, bounded to `max_sessions` and evicted after
+    `ttl` seconds without use. Sessions live in the memory of one worker
+    process, so with several workers every request of a session has to
+    reach the worker that created it
+"""
+
+
+class QuizSessionStore:
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL, max_sessions=QUIZ_SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def _evict(self, now):
+        # the dict is kept in last-used order, so expired sessions are
+        # always at the front
+        while self._sessions:
+            token, session = next(iter(self._sessions.items()))
+            if now - session.touched_at < self.ttl and \
+                    len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[token]
+
+    def create(self, category, question_ids):
+        deck = list(question_ids)
+        random.shuffle(deck)
+        session = QuizSession(category, deck)
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._sessions[token] = session
+            self._evict(session.touched_at)
+        return token, session
+
+    def get(self, token):
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(token)
+            if session is not None:
+                session.touched_at = now
+                self._sessions.move_to_end(token)
+            return session
+
+    def discard(self, token):
+        with self._lock:
+            return self._sessions.pop(token, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,326 @@
+import bisect
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import tempfile
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): snapshot mode leaves reads on the database
+    fcntl = None
+
+from models import db, Question, Category, data_version, question_rows, \
+    format_row, sample_ids
+
+"""
+Question snapshot
+
+An immutable image of the questions and categories tables in one file,
+built by whichever worker first sees a new data version and memory-mapped
+read-only by every worker on the host, so the pages are shared instead of
+copied per process. A new image is written next to the current one and
+renamed over it, which swaps it atomically; workers still mapping the old
+file keep a valid view until they move on.
+
+Layout: a header, then columns of native int32/uint32 arrays and a UTF-8
+string heap. Questions are sorted by id, and each category lists the ids
+of its questions:
+
+    header             magic, database, data version, questions, categories
+    question ids       int32[questions]
+    categories         int32[questions]   (NULL stored as NULL_VALUE)
+    difficulties       int32[questions]
+    question offsets   uint32[questions + 1], into the heap
+    answer offsets     uint32[questions + 1]
+    category ids       int32[categories]
+    category bounds    uint32[categories + 1], into the category question ids
+    category questions int32[...]
+    type offsets       uint32[categories + 1]
+    heap               question texts, answers and category types
+"""
+
+QUESTION_SNAPSHOT = os.getenv('QUESTION_SNAPSHOT', 'false').lower() in (
+    '1', 'true')
+# by default one image per database, named after database_id(), in a
+# directory only this user can enter; on Linux /dev/shm keeps it in memory
+# rather than on disk
+QUESTION_SNAPSHOT_PATH = os.getenv('QUESTION_SNAPSHOT_PATH')
+SNAPSHOT_DIRECTORY = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'trivia-snapshots-{}'.format(os.getuid() if hasattr(os, 'getuid')
+                                 else 0))
+
+MAGIC = b'TRIVIA02'
+HEADER = struct.Struct('<8s8sQII')
+NULL_VALUE = -2 ** 31
+
+
+def database_id(url):
+    # what tells two databases apart: every fresh database starts at data
+    # version 1, so the version alone does not identify an image
+    return hashlib.blake2b('{}://{}:{}/{}'.format(
+        url.drivername, url.host, url.port, url.database).encode('utf-8'),
+        digest_size=8).digest()
+
+
+def private_directory(path):
+    # the images hold every answer and are trusted once their header
+    # matches, so other users must not be able to read or plant them
+    os.makedirs(path, 0o700, exist_ok=True)
+    status = os.lstat(path)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or \
+            status.st_mode & 0o077:
+        raise PermissionError(
+            '{} is not a private directory of this user'.format(path))
+    return path
+
+
+def packed(typecode, values):
+    return array(typecode, values).tobytes()
+
+
+"""
+build_snapshot(path, database, version)
+    writes the image of the current questions and categories of the
+    `database` (a database_id()) for data `version` to `path`, through a
+    temporary file renamed over it
+"""
+
+
+def build_snapshot(path, database, version):
+    heap = bytearray()
+
+    def add_string(value):
+        heap.extend((value or '').encode('utf-8'))
+        return len(heap)
+
+    ids, categories, difficulties, answers = [], [], [], []
+    question_offsets = [0]
+    for row in question_rows().order_by(Question.id):
+        question = format_row(row)
+        ids.append(question['id'])
+        categories.append(NULL_VALUE if question['category'] is None
+                          else question['category'])
+        difficulties.append(NULL_VALUE if question['difficulty'] is None
+                            else question['difficulty'])
+        question_offsets.append(add_string(question['question']))
+        answers.append(question['answer'])
+    answer_offsets = [len(heap)]
+    for answer in answers:
+        answer_offsets.append(add_string(answer))
+
+    category_rows = db.session.query(Category.id, Category.type) \
+        .order_by(Category.id).all()
+    members = {category_id: [] for category_id, _ in category_rows}
+    for question_id, category in zip(ids, categories):
+        if category in members:
+            members[category].append(question_id)
+    bounds, category_questions, type_offsets = [0], [], [len(heap)]
+    for category_id, type in category_rows:
+        category_questions.extend(members[category_id])
+        bounds.append(len(category_questions))
+        type_offsets.append(add_string(type))
+
+    sections = [
+        HEADER.pack(MAGIC, database, version, len(ids), len(category_rows)),
+        packed('i', ids), packed('i', categories), packed('i', difficulties),
+        packed('I', question_offsets), packed('I', answer_offsets),
+        packed('i', [category_id for category_id, _ in category_rows]),
+        packed('I', bounds), packed('i', category_questions),
+        packed('I', type_offsets), bytes(heap)
+    ]
+    directory = os.path.dirname(path) or '.'
+    descriptor, temporary = tempfile.mkstemp(dir=directory,
+                                             prefix='.snapshot-')
+    try:
+        with os.fdopen(descriptor, 'wb') as image:
+            for section in sections:
+                image.write(section)
+        # mkstemp creates it readable by its owner only, and the workers
+        # run as that user
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+"""
+QuestionSnapshot
+    one mapped image: questions and categories read straight from the
+    shared pages, in the shapes the list and quiz endpoints return
+"""
+
+
+class QuestionSnapshot:
+
+    def __init__(self, path):
+        with open(path, 'rb') as image:
+            if os.fstat(image.fileno()).st_uid != os.getuid():
+                raise ValueError('{} belongs to another user'.format(path))
+            self._map = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.database, self.version, questions, categories = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a question snapshot'.format(path))
+
+        view = memoryview(self._map)
+        position = HEADER.size
+
+        def column(typecode, length):
+            nonlocal position
+            start = position
+            position += length * 4
+            return view[start:position].cast(typecode)
+
+        self.ids = column('i', questions)
+        self._categories = column('i', questions)
+        self._difficulties = column('i', questions)
+        self._question_offsets = column('I', questions + 1)
+        self._answer_offsets = column('I', questions + 1)
+        category_ids = column('i', categories)
+        bounds = column('I', categories + 1)
+        category_questions = column('i', bounds[-1] if categories else 0)
+        type_offsets = column('I', categories + 1)
+        self._heap = view[position:]
+
+        self.categories = {}
+        self._category_ids = {}
+        for index, category_id in enumerate(category_ids):
+            self.categories[category_id] = self._string(
+                type_offsets[index], type_offsets[index + 1])
+            self._category_ids[category_id] = \
+                category_questions[bounds[index]:bounds[index + 1]]
+
+    def matches(self, database, version):
+        return self.database == database and self.version == version
+
+    def _string(self, start, end):
+        return str(self._heap[start:end], 'utf-8')
+
+    def _question(self, index):
+        category = self._categories[index]
+        difficulty = self._difficulties[index]
+        return {
+            'id': self.ids[index],
+            'question': self._string(self._question_offsets[index],
+                                     self._question_offsets[index + 1]),
+            'answer': self._string(self._answer_offsets[index],
+                                   self._answer_offsets[index + 1]),
+            'category': None if category == NULL_VALUE else category,
+            'difficulty': None if difficulty == NULL_VALUE else difficulty
+        }
+
+    @property
+    def total(self):
+        return len(self.ids)
+
+    def category_total(self, category):
+        return len(self._category_ids.get(category, ()))
+
+    def question_ids(self, category=None):
+        if category is None:
+            return self.ids
+        return self._category_ids.get(int(category), self.ids[:0])
+
+    def get(self, question_id):
+        index = bisect.bisect_left(self.ids, question_id)
+        if index < len(self.ids) and self.ids[index] == question_id:
+            return self._question(index)
+        return None
+
+    def page(self, offset, limit, category=None, after_id=None):
+        """the questions of a list page, like paginate_questions()"""
+        ids = self.question_ids(category)
+        if after_id is not None:
+            offset = bisect.bisect_right(ids, after_id)
+        if category is None:
+            return [self._question(index) for index in
+                    range(offset, min(offset + limit, len(ids)))]
+        return [self.get(question_id)
+                for question_id in ids[offset:offset + limit]]
+
+    def sample_many(self, count, category=None, exclude=()):
+        return sample_ids(self.question_ids(category), count, exclude)
+
+
+"""
+SnapshotStore
+    the snapshot of the current data version of the app's database for
+    this worker. A worker that finds the image on disk outdated, or made
+    from another database, rebuilds it under a file lock; the others answer
+    from the database until the new image is there
+"""
+
+
+class SnapshotStore:
+
+    def __init__(self, path=QUESTION_SNAPSHOT_PATH):
+        self.configured_path = path
+        self._snapshot = None
+        self.builds = 0
+
+    def _path(self, database):
+        if self.configured_path:
+            return self.configured_path
+        return os.path.join(private_directory(SNAPSHOT_DIRECTORY),
+                            'trivia-questions-{}.snapshot'.format(
+                                database.hex()))
+
+    def current(self):
+        """the snapshot of the current data version, or None when the
+        caller should query the database instead"""
+        if fcntl is None:
+            # no flock (Windows): the image is never built
+            return None
+        database = database_id(db.engine.url)
+        version = data_version.current()[0]
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.matches(database, version):
+            return snapshot
+
+        try:
+            path = self._path(database)
+        except OSError:
+            return None
+        snapshot = self._open(path)
+        if snapshot is None or not snapshot.matches(database, version):
+            snapshot = self._rebuild(path, database, version)
+        if snapshot is not None and snapshot.matches(database, version):
+            self._snapshot = snapshot
+            return snapshot
+        return None
+
+    def _open(self, path):
+        try:
+            return QuestionSnapshot(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def _rebuild(self, path, database, version):
+        try:
+            # never through a symlink someone placed at the lock's path
+            lock = os.open(path + '.lock',
+                           os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # another worker is building it
+                    return None
+                snapshot = self._open(path)
+                if snapshot is not None and \
+                        snapshot.matches(database, version):
+                    return snapshot
+                build_snapshot(path, database, version)
+                self.builds += 1
+                return self._open(path)
+            finally:
+                os.close(lock)
+        except OSError:
+            # the image cannot be written there (missing directory, no
+            # permission, full disk): reads stay on the database
+            return None
@@ -0,0 +1,188 @@
+from datetime import datetime
+
+from sqlalchemy import text
+
+"""
+Schema migrations
+
+Every migration is a (version, description, function) entry in MIGRATIONS
+and is applied once, in order, inside its own transaction. The version of
+the last applied migration is kept in the single-row `schema_version`
+table. Migrations only ever move forward and are written so that running
+one against a schema that already has its change is harmless, e.g. a
+database created by `db.create_all()` from the current models.
+"""
+
+# arbitrary key of the Postgres advisory lock that keeps two workers from
+# migrating at the same time
+MIGRATION_LOCK_ID = 20220614
+
+# the document question searches are matched against
+QUESTION_TSVECTOR = "to_tsvector('simple', coalesce(questions.question, ''))"
+
+
+def column_type(connection, table, column):
+    if connection.dialect.name == 'postgresql':
+        return connection.execute(text(
+            'SELECT data_type FROM information_schema.columns '
+            'WHERE table_name = :table AND column_name = :column'),
+            table=table, column=column).scalar()
+    for row in connection.execute(text('PRAGMA table_info({})'.format(table))):
+        if row[1] == column:
+            return row[2].lower()
+
+
+def category_to_integer_foreign_key(connection):
+    # questions.category was mapped as a string while the column holds
+    # category ids; make it an integer referencing categories.id
+    if connection.dialect.name == 'postgresql':
+        # ALTER COLUMN ... TYPE rewrites the table under an exclusive lock
+        # even when the type does not change, e.g. on a schema made by
+        # db.create_all()
+        if column_type(connection, 'questions', 'category') != 'integer':
+            connection.execute(text(
+                'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+                'USING category::integer'))
+        connection.execute(text('''
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conrelid = 'questions'::regclass AND contype = 'f'
+                ) THEN
+                    ALTER TABLE questions ADD CONSTRAINT category
+                        FOREIGN KEY (category) REFERENCES categories(id)
+                        ON UPDATE CASCADE ON DELETE SET NULL;
+                END IF;
+            END
+            $$'''))
+        return
+
+    if column_type(connection, 'questions', 'category') == 'integer':
+        return
+    # SQLite cannot change a column type in place: rebuild the table
+    connection.execute(text('''
+        CREATE TABLE questions_new (
+            id INTEGER NOT NULL PRIMARY KEY,
+            question VARCHAR,
+            answer VARCHAR,
+            category INTEGER REFERENCES categories (id)
+                ON UPDATE CASCADE ON DELETE SET NULL,
+            difficulty INTEGER
+        )'''))
+    connection.execute(text(
+        'INSERT INTO questions_new (id, question, answer, category, '
+        'difficulty) SELECT id, question, answer, '
+        'CAST(category AS INTEGER), difficulty FROM questions'))
+    connection.execute(text('DROP TABLE questions'))
+    connection.execute(text('ALTER TABLE questions_new RENAME TO questions'))
+
+
+def add_question_indexes(connection):
+    # category filters and category pages ordered by id, and difficulty
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+        'ON questions (category, id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_difficulty '
+        'ON questions (difficulty)'))
+
+
+def add_question_search_index(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_question_tsv ON questions '
+        'USING GIN ({})'.format(QUESTION_TSVECTOR)))
+
+
+def add_data_version(connection):
+    # the counter DataVersion bumps on every question and category write
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS data_version ('
+        'id integer NOT NULL PRIMARY KEY, version bigint NOT NULL, '
+        'updated_at timestamp NOT NULL)'))
+    if connection.execute(text('SELECT count(*) FROM data_version')).scalar():
+        return
+    connection.execute(text(
+        'INSERT INTO data_version (id, version, updated_at) '
+        'VALUES (1, 1, :now)'), now=datetime.utcnow())
+
+
+def add_question_stats(connection):
+    # the per category x difficulty counts QuestionStats keeps up to date
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS question_stats ('
+        'category integer NOT NULL, difficulty integer NOT NULL, '
+        'count integer NOT NULL, PRIMARY KEY (category, difficulty))'))
+    connection.execute(text('DELETE FROM question_stats'))
+    connection.execute(text(
+        'INSERT INTO question_stats (category, difficulty, count) '
+        'SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*) '
+        'FROM questions GROUP BY coalesce(category, 0), '
+        'coalesce(difficulty, 0)'))
+
+
+MIGRATIONS = [
+    (1, 'questions.category as an integer foreign key',
+     category_to_integer_foreign_key),
+    (2, 'indexes on questions (category, id) and (difficulty)',
+     add_question_indexes),
+    (3, 'full-text search index on questions.question',
+     add_question_search_index),
+    (4, 'data_version table', add_data_version),
+    (5, 'question_stats table', add_question_stats),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version (version integer NOT NULL)'))
+    version = connection.execute(
+        text('SELECT max(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+"""
+applied_version(connection)
+    the version of the last applied migration, 0 for a database that was
+    never migrated; unlike current_version() it does not write, so it can
+    run on every readiness check
+"""
+
+
+def applied_version(connection):
+    if not connection.dialect.has_table(connection, 'schema_version'):
+        return 0
+    version = connection.execute(
+        text('SELECT max(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+"""
+migrate(engine)
+    applies the pending migrations and returns the descriptions of the
+    ones that were applied
+"""
+
+
+def migrate(engine, target=LATEST_VERSION):
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version > target:
+            break
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text('SELECT pg_advisory_xact_lock(:id)'),
+                                   id=MIGRATION_LOCK_ID)
+            if current_version(connection) >= version:
+                continue
+            upgrade(connection)
+            connection.execute(text('DELETE FROM schema_version'))
+            connection.execute(
+                text('INSERT INTO schema_version (version) VALUES (:version)'),
+                version=version)
+        applied.append('{}: {}'.format(version, description))
+    return applied
@@ -1,8 +1,23 @@
+import bisect
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import queue
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, \
+    ForeignKey, Index, create_engine, event, exc, func, inspect, orm, \
+    select, text
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
+from migrations import migrate, QUESTION_TSVECTOR
+
 DB_HOST = os.getenv('DB_HOST', '127.0.0.1:5432')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'atoncemedia2022')
@@ -11,21 +26,296 @@ DB_NAME = os.getenv('DB_NAME', 'trivia')
 database_path = 'postgresql+psycopg2://{}:{}@{}/{}'.format(
     DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
 
+# connection pool of every engine: connections kept open, extra connections
+# allowed under load, seconds to wait for a free connection, seconds before
+# a connection is replaced, and whether to test connections on checkout
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in (
+    '1', 'true')
+# milliseconds a single statement may run (Postgres only, 0 for no limit)
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '30000'))
+
+# read replicas of the database, as a comma separated list of hosts
+DB_REPLICA_HOSTS = [host for host in
+                    os.getenv('DB_REPLICA_HOSTS', '').split(',') if host]
+
+replica_paths = ['postgresql+psycopg2://{}:{}@{}/{}'.format(
+    DB_USER, DB_PASSWORD, host, DB_NAME) for host in DB_REPLICA_HOSTS]
+
+# seconds a replica may lag behind the primary before reads go back to the
+# primary, and how often that lag is checked
+MAX_REPLICA_LAG = float(os.getenv('MAX_REPLICA_LAG', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '5'))
 
-db = SQLAlchemy()
+# seconds before the in-memory question totals are re-read from the
+# database, to pick up writes made by other worker processes
+QUESTION_COUNT_TTL = int(os.getenv('QUESTION_COUNT_TTL', '60'))
+# write-behind mode: question inserts and deletes from concurrent requests
+# are committed together, up to WRITE_BATCH_SIZE per transaction, waiting at
+# most WRITE_MAX_DELAY milliseconds for a batch to fill
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'false').lower() in ('1', 'true')
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_MAX_DELAY = float(os.getenv('WRITE_MAX_DELAY', '5'))
+# seconds the data version is cached before it is re-read, which bounds how
+# long another worker's write can go unnoticed by conditional GETs
+DATA_VERSION_TTL = float(os.getenv('DATA_VERSION_TTL', '1'))
+
+
+"""
+ReplicaRouter
+    picks the read replica for a request marked with @read_only: one of the
+    replicas whose replication lag is within MAX_REPLICA_LAG, or None to
+    stay on the primary
+"""
+
+REPLICA_LAG_QUERY = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+    'THEN 0 ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) '
+    'END')
+
+
+class ReplicaRouter:
+
+    def __init__(self, max_lag=MAX_REPLICA_LAG,
+                 check_interval=REPLICA_LAG_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # engine url -> (checked at, healthy)
+        self._health = {}
+        self.routed = 0
+        self.fallbacks = 0
+
+    def _lag(self, engine):
+        if engine.dialect.name != 'postgresql':
+            return 0
+        with engine.connect() as connection:
+            return connection.execute(REPLICA_LAG_QUERY).scalar() or 0
+
+    def is_healthy(self, engine):
+        key = str(engine.url)
+        now = time.monotonic()
+        checked_at, healthy = self._health.get(key, (None, False))
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return healthy
+        try:
+            healthy = self._lag(engine) <= self.max_lag
+        except Exception:
+            healthy = False
+        with self._lock:
+            self._health[key] = (now, healthy)
+        return healthy
+
+    def choose(self, app):
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        keys = [key for key in binds if key.startswith('replica_')]
+        random.shuffle(keys)
+        for key in keys:
+            engine = db.get_engine(app, bind=key)
+            if self.is_healthy(engine):
+                self.routed += 1
+                return engine
+        if keys:
+            self.fallbacks += 1
+        return None
+
+
+replica_router = ReplicaRouter()
+
+
+"""
+read_only(view)
+    marks a view that only reads, so its queries may be served by a replica
+"""
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+"""
+TimedQueuePool
+    a QueuePool that also records how long checkouts wait for a connection
+"""
+
+
+class TimedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stats(self):
+        return {
+            'pool': 'queue',
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'checkouts': self.waits,
+            'wait_seconds_total': round(self.wait_seconds, 6),
+            'wait_seconds_max': round(self.max_wait_seconds, 6),
+            'timeouts': self.timeouts
+        }
+
+
+"""
+pool_status(app)
+    the state of the connection pool of the primary and of every replica
+"""
+
+
+def pool_status(app):
+    binds = [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+    status = {}
+    for bind in binds:
+        pool = db.get_engine(app, bind=bind).pool
+        if isinstance(pool, TimedQueuePool):
+            status[bind or 'primary'] = pool.stats()
+        else:
+            status[bind or 'primary'] = {'pool': type(pool).__name__,
+                                         'status': pool.status()}
+    return status
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and \
+                g.get('db_read_only'):
+            # one replica for the whole request, so its reads are consistent
+            if 'db_replica' not in g:
+                g.db_replica = replica_router.choose(self.app)
+            if g.db_replica is not None:
+                return g.db_replica
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    # DB_STATEMENT_TIMEOUT is set once per connection (see
+    # apply_driver_hacks); only a request that raises or lifts it through
+    # g.statement_timeout pays for a SET LOCAL in its transactions
+    if connection.dialect.name != 'postgresql' or not has_request_context():
+        return
+    timeout = g.get('statement_timeout')
+    if timeout is not None:
+        connection.execute(text('SET LOCAL statement_timeout = {:d}'.format(
+            int(timeout))))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        options['pool_pre_ping'] = app.config['DB_POOL_PRE_PING']
+        if sa_url.drivername.startswith('postgresql'):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = ' '.join(filter(None, [
+                connect_args.get('options'),
+                '-c statement_timeout={:d}'.format(
+                    int(app.config['DB_STATEMENT_TIMEOUT']))]))
+        if sa_url.drivername.startswith('sqlite'):
+            # keep the pool flask_sqlalchemy chose for SQLite: a StaticPool
+            # for an in-memory database, which lives only as long as its one
+            # connection, and a NullPool for a file, whose connections
+            # cannot be shared between threads
+            return
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': app.config['DB_POOL_SIZE'],
+            'max_overflow': app.config['DB_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+            'pool_recycle': app.config['DB_POOL_RECYCLE']
+        })
+
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with optional read
+    replicas for the views marked @read_only; the DB_POOL_* and
+    DB_STATEMENT_TIMEOUT settings can be overridden in the app config.
+    It does not touch the database: the schema is provisioned beforehand
+    by create_schema(), and GET /ready reports whether it is in place
 """
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("DB_POOL_SIZE", DB_POOL_SIZE)
+    app.config.setdefault("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW)
+    app.config.setdefault("DB_POOL_TIMEOUT", DB_POOL_TIMEOUT)
+    app.config.setdefault("DB_POOL_RECYCLE", DB_POOL_RECYCLE)
+    app.config.setdefault("DB_POOL_PRE_PING", DB_POOL_PRE_PING)
+    app.config.setdefault("DB_STATEMENT_TIMEOUT", DB_STATEMENT_TIMEOUT)
+    app.config["SQLALCHEMY_BINDS"] = {
+        'replica_{}'.format(index): path
+        for index, path in enumerate(replica_paths)}
     db.app = app
     db.init_app(app)
-    db.create_all()
+    app.config.setdefault("WRITE_BEHIND", WRITE_BEHIND)
+    questions_changed()
+    category_registry.invalidate()
+    if app.config["WRITE_BEHIND"]:
+        write_queue.start(db.engine)
+    else:
+        write_queue.stop()
+
+
+"""
+create_schema(engine)
+    creates the missing tables and applies the pending migrations, and
+    returns the descriptions of the migrations applied; run once per
+    deployment with `flask migrate`, not every time an app is built
+"""
+
+
+def create_schema(engine):
+    db.Model.metadata.create_all(engine)
+    return migrate(engine)
+
+
+"""
+questions_changed()
+    drops every in-memory view of the questions table, for writes that
+    bypass Question.insert()/delete() such as bulk imports
+"""
+
+
+def questions_changed():
+    data_version.invalidate()
+    question_counts.invalidate()
+    question_search.invalidate()
+    question_ids.invalidate()
 
 
 """
@@ -36,11 +326,16 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -50,15 +345,59 @@ class Question(db.Model):
         self.difficulty = difficulty
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        if write_queue.running:
+            # blocks until the batch holding this insert has committed
+            self.id = write_queue.insert({
+                'question': self.question,
+                'answer': self.answer,
+                'category': self.category,
+                'difficulty': self.difficulty
+            })
+        else:
+            db.session.add(self)
+            data_version.bump()
+            question_stats.add(db.session,
+                               {(self.category, self.difficulty): 1})
+            db.session.commit()
+        data_version.invalidate()
+        question_counts.add(self.category, 1)
+        question_search.index(self)
+        question_ids.add(self.id, self.category)
 
     def update(self):
+        data_version.bump()
+        # move the question between stats cells if it was re-classified
+        state = inspect(self)
+        before = []
+        for name in ('category', 'difficulty'):
+            history = state.attrs[name].history
+            before.append(history.deleted[0] if history.deleted
+                          else getattr(self, name))
+        before, after = tuple(before), (self.category, self.difficulty)
+        # both in one dict would collapse into +1 when nothing moved
+        if before != after:
+            question_stats.add(db.session, {before: -1, after: 1})
         db.session.commit()
+        data_version.invalidate()
+        # the category may have changed
+        question_counts.invalidate()
+        question_search.index(self)
+        question_ids.invalidate()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        if write_queue.running:
+            write_queue.delete((self.id, self.category, self.difficulty))
+            db.session.expunge(self)
+        else:
+            db.session.delete(self)
+            data_version.bump()
+            question_stats.add(db.session,
+                               {(self.category, self.difficulty): -1})
+            db.session.commit()
+        data_version.invalidate()
+        question_counts.add(self.category, -1)
+        question_search.remove(self.id)
+        question_ids.remove(self.id, self.category)
 
     def format(self):
         return {
@@ -70,6 +409,32 @@ class Question(db.Model):
         }
 
 
+"""
+question_rows()
+    a query for the question columns only: rows come back as plain named
+    tuples, skipping ORM object hydration and the session identity map,
+    for read paths that only serialize questions
+"""
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+
+
+def question_rows():
+    return db.session.query(*QUESTION_COLUMNS)
+
+
+def format_row(row):
+    # the same keys as Question.format()
+    return {
+        'id': row[0],
+        'question': row[1],
+        'answer': row[2],
+        'category': row[3],
+        'difficulty': row[4]
+    }
+
+
 """
 Category
 
@@ -85,8 +450,610 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        data_version.bump()
+        db.session.commit()
+        data_version.invalidate()
+        category_registry.invalidate()
+
+    def update(self):
+        data_version.bump()
+        db.session.commit()
+        data_version.invalidate()
+        category_registry.invalidate()
+
+    def delete(self):
+        db.session.delete(self)
+        data_version.bump()
+        # its questions are set to NULL (ON DELETE SET NULL), so their
+        # stats move to category 0
+        question_stats.uncategorize(db.session, self.id)
+        db.session.commit()
+        data_version.invalidate()
+        category_registry.invalidate()
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+"""
+QuestionCounter
+    global and per-category question totals, summed from the exact
+    question_stats table and then kept up to date by
+    Question.insert()/delete(), so handlers never have to count the table
+    themselves. They are re-read when the data version moves, so pages
+    cached under a version always carry that version's totals
+"""
+
+
+class QuestionCounter:
+
+    def __init__(self, ttl=QUESTION_COUNT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counts = None
+        self._data_version = None
+        self._loaded_at = 0
+
+    def _ensure_loaded(self):
+        current = data_version.current()[0]
+        counts = self._counts
+        if counts is not None and self._data_version == current and \
+                time.monotonic() - self._loaded_at < self.ttl:
+            return counts
+        table = question_stats_table
+        rows = db.session.execute(
+            select([table.c.category, func.sum(table.c.count)])
+            .group_by(table.c.category)).fetchall()
+        with self._lock:
+            self._counts = {str(category): int(count)
+                            for category, count in rows}
+            self._data_version = current
+            self._loaded_at = time.monotonic()
+            return self._counts
+
+    def total(self):
+        return sum(self._ensure_loaded().values())
+
+    def for_category(self, category):
+        return self._ensure_loaded().get(str(category), 0)
+
+    def add(self, category, delta):
+        with self._lock:
+            if self._counts is None:
+                return
+            key = str(stats_key(category))
+            self._counts[key] = self._counts.get(key, 0) + delta
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = None
+
+
+question_counts = QuestionCounter()
+
+
+"""
+CategoryRegistry
+    the id -> type mapping of all categories, loaded once and served from
+    memory together with its pre-serialized JSON; any Category write
+    drops the cached copy and bumps `version`. It is also re-read when the
+    data version moves, which picks up categories written by other worker
+    processes or scripts within DATA_VERSION_TTL seconds
+"""
+
+
+class CategoryRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (categories, their JSON), replaced as one so a reader never pairs
+        # one load's dict with another's JSON, or with None
+        self._loaded = None
+        self._data_version = None
+        self.version = 0
+
+    def _ensure_loaded(self):
+        current = data_version.current()[0]
+        loaded = self._loaded
+        if loaded is not None and self._data_version == current:
+            return loaded
+        rows = db.session.query(Category.id, Category.type) \
+            .order_by(Category.id).all()
+        categories = {id: type for id, type in rows}
+        with self._lock:
+            if loaded is not None and categories != loaded[0]:
+                self.version += 1
+            self._loaded = (categories, json.dumps(categories,
+                                                   separators=(',', ':')))
+            self._data_version = current
+            return self._loaded
+
+    def as_dict(self):
+        return self._ensure_loaded()[0]
+
+    def as_dict_and_json(self):
+        return self._ensure_loaded()
+
+    def __contains__(self, category_id):
+        return category_id in self._ensure_loaded()[0]
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+            self.version += 1
+
+
+category_registry = CategoryRegistry()
+
+
+"""
+QuestionSearch
+    relevance-ranked, paginated search over question text. Every word of
+    the search term has to match the start of a word in the question.
+    On Postgres this is a full-text query served by the GIN expression index
+    added by migration 3; on other databases (SQLite in tests) an in-process
+    inverted index is built once and kept in sync by
+    Question.insert()/update()/delete()
+"""
+
+
+def tokenize(value):
+    return re.findall(r'\w+', (value or '').lower())
+
+
+class QuestionSearch:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # token -> {question_id: occurrences}, and the sorted token list
+        # for prefix lookups
+        self._postings = None
+        self._tokens = []
+        # question_id -> tokens, so a question can be unindexed cheaply
+        self._documents = {}
+
+    def _is_postgres(self):
+        return db.session.get_bind().dialect.name == 'postgresql'
+
+    def search(self, term, offset=0, limit=10):
+        """returns (questions, total_matches) for one page of results"""
+        tokens = tokenize(term)
+        if not tokens:
+            return [], 0
+        if self._is_postgres():
+            return self._search_postgres(tokens, offset, limit)
+        return self._search_index(tokens, offset, limit)
+
+    def _search_postgres(self, tokens, offset, limit):
+        params = {'query': ' & '.join(token + ':*' for token in tokens)}
+        match = text("{} @@ to_tsquery('simple', :query)"
+                     .format(QUESTION_TSVECTOR))
+        rank = text("ts_rank({}, to_tsquery('simple', :query)) DESC"
+                    .format(QUESTION_TSVECTOR))
+        total = db.session.query(func.count(Question.id)) \
+            .filter(match).params(**params).scalar()
+        questions = Question.query.filter(match) \
+            .order_by(rank, Question.id).params(**params) \
+            .offset(offset).limit(limit).all()
+        return questions, total
+
+    def _ensure_loaded(self):
+        if self._postings is not None:
+            return
+        rows = db.session.query(Question.id, Question.question).all()
+        with self._lock:
+            self._postings = {}
+            self._documents = {}
+            for question_id, question in rows:
+                self._add(question_id, question)
+            self._tokens = sorted(self._postings)
+
+    def _add(self, question_id, question, keep_sorted=False):
+        tokens = tokenize(question)
+        self._documents[question_id] = set(tokens)
+        for token in tokens:
+            if token not in self._postings:
+                self._postings[token] = {}
+                if keep_sorted:
+                    bisect.insort(self._tokens, token)
+            counts = self._postings[token]
+            counts[question_id] = counts.get(question_id, 0) + 1
+
+    def _discard(self, question_id):
+        for token in self._documents.pop(question_id, ()):
+            counts = self._postings[token]
+            counts.pop(question_id, None)
+            if not counts:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def _search_index(self, tokens, offset, limit):
+        self._ensure_loaded()
+        scores = None
+        with self._lock:
+            for token in tokens:
+                # every indexed word starting with the token
+                matches = {}
+                start = bisect.bisect_left(self._tokens, token)
+                for word in self._tokens[start:]:
+                    if not word.startswith(token):
+                        break
+                    for question_id, count in self._postings[word].items():
+                        matches[question_id] = \
+                            matches.get(question_id, 0) + count
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {question_id: score + matches[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in matches}
+        ranked = sorted(scores, key=lambda question_id:
+                        (-scores[question_id], question_id))
+        page = ranked[offset:offset + limit]
+        if not page:
+            return [], len(ranked)
+        questions = {question.id: question for question in
+                     Question.query.filter(Question.id.in_(page)).all()}
+        return [questions[question_id] for question_id in page
+                if question_id in questions], len(ranked)
+
+    def index(self, question):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._discard(question.id)
+            self._add(question.id, question.question, keep_sorted=True)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._discard(question_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._postings = None
+            self._tokens = []
+            self._documents = {}
+
+
+question_search = QuestionSearch()
+
+
+# random draws that may land on an already-played question before the
+# remaining candidates are listed explicitly
+MAX_SAMPLE_ATTEMPTS = 8
+
+
+"""
+sample_ids(ids, count, exclude)
+    up to `count` distinct random ids of the sequence `ids` that are not in
+    `exclude`; rejection sampling keeps the draw uniform over the eligible
+    ids without copying them, unless most of them are excluded
+"""
+
+
+def sample_ids(ids, count, exclude=()):
+    seen = set(exclude)
+    chosen = []
+    for _ in range(MAX_SAMPLE_ATTEMPTS * count):
+        if len(chosen) == count or not ids:
+            return chosen
+        question_id = ids[random.randrange(len(ids))]
+        if question_id not in seen:
+            seen.add(question_id)
+            chosen.append(question_id)
+    remaining = [question_id for question_id in ids
+                 if question_id not in seen]
+    return chosen + random.sample(
+        remaining, min(count - len(chosen), len(remaining)))
+
+
+"""
+QuestionIdIndex
+    the ids of all questions, overall and per category, held in memory so
+    a quiz can draw a uniformly random question without loading every
+    candidate row. Loaded with one id/category query, kept up to date by
+    Question.insert()/delete() and re-read after QUESTION_COUNT_TTL seconds
+"""
+
+
+class QuestionIdIndex:
+
+    def __init__(self, ttl=QUESTION_COUNT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._all = None
+        self._by_category = {}
+        self._loaded_at = 0
+
+    @property
+    def stale(self):
+        return self._all is None or \
+            time.monotonic() - self._loaded_at >= self.ttl
+
+    def _ensure_loaded(self):
+        if not self.stale:
+            return
+        self.load(db.session.query(Question.id, Question.category)
+                  .order_by(Question.id).all())
+
+    def load(self, rows):
+        """replaces the index with (id, category) rows in id order, for
+        callers that fetch them without db.session"""
+        with self._lock:
+            self._all = []
+            self._by_category = {}
+            for question_id, category in rows:
+                self._all.append(question_id)
+                self._by_category.setdefault(
+                    str(category), []).append(question_id)
+            self._loaded_at = time.monotonic()
+
+    def ids(self, category=None):
+        self._ensure_loaded()
+        if category is None:
+            return self._all
+        return self._by_category.get(str(category), [])
+
+    def sample(self, category=None, exclude=()):
+        """a uniformly random question id not in `exclude`, or None"""
+        chosen = self.sample_many(1, category, exclude)
+        return chosen[0] if chosen else None
+
+    def sample_many(self, count, category=None, exclude=()):
+        """up to `count` distinct random question ids not in `exclude`"""
+        return sample_ids(self.ids(category), count, exclude)
+
+    def add(self, question_id, category):
+        with self._lock:
+            if self._all is None:
+                return
+            bisect.insort(self._all, question_id)
+            bisect.insort(self._by_category.setdefault(str(category), []),
+                          question_id)
+
+    def remove(self, question_id, category):
+        with self._lock:
+            if self._all is None:
+                return
+            for ids in (self._all, self._by_category.get(str(category), [])):
+                position = bisect.bisect_left(ids, question_id)
+                if position < len(ids) and ids[position] == question_id:
+                    del ids[position]
+
+    def invalidate(self):
+        with self._lock:
+            self._all = None
+            self._by_category = {}
+
+
+question_ids = QuestionIdIndex()
+
+
+"""
+DataVersion
+    a counter in the single-row `data_version` table, bumped in the same
+    transaction as every question and category write, with the time of the
+    last write. Workers cache it for DATA_VERSION_TTL seconds, so checking
+    whether a client's copy is current rarely needs the database
+"""
+
+data_version_table = db.Table(
+    'data_version',
+    Column('id', Integer, primary_key=True),
+    Column('version', BigInteger, nullable=False),
+    Column('updated_at', DateTime, nullable=False)
+)
+
+
+class DataVersion:
+
+    def __init__(self, ttl=DATA_VERSION_TTL):
+        self.ttl = ttl
+        self._current = None
+        self._loaded_at = 0
+
+    def current(self):
+        """returns (version, updated_at)"""
+        current = self._current
+        if current is not None and \
+                time.monotonic() - self._loaded_at < self.ttl:
+            return current
+        row = db.session.execute(select([
+            data_version_table.c.version,
+            data_version_table.c.updated_at])).first()
+        current = (row[0], row[1]) if row else (0, datetime(1970, 1, 1))
+        self._current = current
+        self._loaded_at = time.monotonic()
+        return current
+
+    def bump(self, connection=None):
+        # runs in the caller's transaction and commits with it
+        (connection or db.session).execute(data_version_table.update().values(
+            version=data_version_table.c.version + 1,
+            updated_at=datetime.utcnow()))
+
+    def invalidate(self):
+        self._current = None
+
+
+data_version = DataVersion()
+
+
+"""
+WriteQueue
+    group commit for question writes in write-behind mode. Callers hand
+    their insert or delete to a background thread and wait for it; the
+    thread gathers the writes of concurrent requests into one transaction
+    of up to `batch_size` writes, waiting at most `max_delay` milliseconds
+    for more to arrive, so a burst costs one commit per batch instead of
+    one per write. When a batch fails its writes are retried one by one,
+    so each caller gets its own id or error
+"""
+
+
+class WriteQueue:
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, max_delay=WRITE_MAX_DELAY):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.engine = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.writes = 0
+
+    @property
+    def running(self):
+        return self.engine is not None
+
+    def start(self, engine):
+        self.engine = engine
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='question-write-queue', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.engine = None
+
+    def _submit(self, operation, value):
+        future = Future()
+        self._queue.put((operation, value, future))
+        return future.result()
+
+    def insert(self, values):
+        """inserts a question row and returns its id"""
+        return self._submit('insert', values)
+
+    def delete(self, question):
+        """deletes an (id, category, difficulty) question and returns the
+        number of rows deleted"""
+        return self._submit('delete', question)
+
+    def _execute(self, connection, operation, value):
+        table = Question.__table__
+        if operation == 'insert':
+            question_stats.add(connection, {
+                (value['category'], value['difficulty']): 1})
+            return connection.execute(
+                table.insert().values(**value)).inserted_primary_key[0]
+        question_id, category, difficulty = value
+        deleted = connection.execute(
+            table.delete().where(table.c.id == question_id)).rowcount
+        if deleted:
+            question_stats.add(connection, {(category, difficulty): -1})
+        return deleted
+
+    def _commit(self, batch):
+        with self.engine.begin() as connection:
+            results = [self._execute(connection, operation, value)
+                       for operation, value, _ in batch]
+            data_version.bump(connection)
+        return results
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay / 1000
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._commit(batch)
+            except Exception:
+                # find the failing writes: commit the rest one at a time
+                for write in batch:
+                    try:
+                        write[2].set_result(self._commit([write])[0])
+                    except Exception as error:
+                        write[2].set_exception(error)
+                continue
+            finally:
+                self.batches += 1
+                self.writes += len(batch)
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+write_queue = WriteQueue()
+
+
+"""
+QuestionStats
+    question counts per category and difficulty in the `question_stats`
+    table, changed in the same transaction as every question write and
+    category delete, so the stats endpoint reads categories x difficulties
+    rows and never scans the questions table. Questions without a category
+    or difficulty are counted under 0
+"""
+
+question_stats_table = db.Table(
+    'question_stats',
+    Column('category', Integer, primary_key=True),
+    Column('difficulty', Integer, primary_key=True),
+    Column('count', Integer, nullable=False)
+)
+
+# Postgres and SQLite (3.24+) share the upsert syntax
+UPSERT_QUESTION_STATS = text(
+    'INSERT INTO question_stats (category, difficulty, count) '
+    'VALUES (:category, :difficulty, :delta) '
+    'ON CONFLICT (category, difficulty) '
+    'DO UPDATE SET count = question_stats.count + :delta')
+
+
+def stats_key(value):
+    return int(value) if value is not None else 0
+
+
+class QuestionStats:
+
+    def add(self, connection, deltas):
+        """applies {(category, difficulty): delta} in `connection`, a
+        session or connection whose transaction holds the write"""
+        merged = {}
+        for (category, difficulty), delta in deltas.items():
+            key = (stats_key(category), stats_key(difficulty))
+            merged[key] = merged.get(key, 0) + delta
+        for (category, difficulty), delta in merged.items():
+            if delta:
+                connection.execute(UPSERT_QUESTION_STATS, {
+                    'category': category, 'difficulty': difficulty,
+                    'delta': delta})
+
+    def uncategorize(self, connection, category):
+        """moves the counts of a deleted category to category 0, in the
+        transaction of the delete"""
+        table = question_stats_table
+        rows = connection.execute(
+            select([table.c.difficulty, table.c.count])
+            .where(table.c.category == category)).fetchall()
+        connection.execute(table.delete().where(table.c.category == category))
+        self.add(connection, {(None, difficulty): count
+                              for difficulty, count in rows})
+
+    def all(self):
+        return db.session.execute(select([
+            question_stats_table.c.category,
+            question_stats_table.c.difficulty,
+            question_stats_table.c.count
+        ]).where(question_stats_table.c.count > 0)).fetchall()
+
+
+question_stats = QuestionStats()
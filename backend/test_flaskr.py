@@ -1,34 +1,35 @@
+import asyncio
 import difflib
 import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from this import d
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, StaticPool
 
+from flaskr import create_app, asgi, snapshot
+from models import db, setup_db, Question, Category, category_registry, \
+    replica_router, write_queue, data_version, data_version_table, \
+    question_stats, TimedQueuePool
+from migrations import LATEST_VERSION
+from fixtures import TransactionalTestCase, commits
 
-class TriviaTestCase(unittest.TestCase):
+
+class TriviaTestCase(TransactionalTestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
         """Define test variables and initialize app."""
+        super().setUp()
         self.app = create_app()
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}:{}@{}/{}".format(
-            "postgres", "atoncemedia2022", "localhost:5432", self.database_name
-        )
         setup_db(self.app, self.database_path)
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after reach test"""
         pass
@@ -47,6 +48,181 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total_questions"])
         self.assertTrue(len(data["questions"]))
 
+    def test_get_questions_after_id(self):
+        res = self.client().get("/api/v1/questions?after_id=5")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(len(data["questions"]))
+        self.assertTrue(all(q["id"] > 5 for q in data["questions"]))
+
+    def test_get_questions_by_ids(self):
+        res = self.client().get("/api/v1/questions?ids=9,5,1000,9")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([q["id"] for q in data["questions"]], [9, 5])
+        self.assertEqual(data["missing"], [1000])
+
+    def test_400_get_questions_by_invalid_ids(self):
+        res = self.client().get("/api/v1/questions?ids=1,two")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_404_get_questions_beyond_last_page(self):
+        res = self.client().get("/api/v1/questions?page=1000")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+
+    def test_schema_is_migrated(self):
+        with self.app.app_context():
+            version = db.session.execute(
+                "SELECT max(version) FROM schema_version").scalar()
+
+        self.assertEqual(version, LATEST_VERSION)
+
+    def test_ready(self):
+        res = self.client().get("/ready")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["schema_version"], LATEST_VERSION)
+
+    def test_create_app_does_no_database_work(self):
+        app = create_app()
+        # an empty database stays empty until `flask migrate` runs
+        setup_db(app, "sqlite://")
+        res = app.test_client().get("/ready")
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)["schema_version"], 0)
+
+    def test_reads_are_routed_to_replica(self):
+        app = create_app()
+        setup_db(app, self.database_path, [self.database_path])
+        client = app.test_client()
+
+        routed = replica_router.routed
+        res = client.get("/api/v1/questions")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replica_router.routed, routed + 1)
+
+        res = client.post("/api/v1/questions",
+                          json={"question": "Which planet is largest?",
+                                "answer": "Jupiter", "category": "1",
+                                "difficulty": "1"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replica_router.routed, routed + 1)
+
+    def test_metrics(self):
+        self.client().get("/api/v1/questions")
+        res = self.client().get("/metrics")
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count'
+                      '{endpoint="retrieve_questions"} 1', body)
+        self.assertIn('trivia_sql_statements_total'
+                      '{endpoint="retrieve_questions"}', body)
+
+    def test_pool_status(self):
+        self.client().get("/api/v1/questions")
+        res = self.client().get("/metrics/pool")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("primary", data["pools"])
+        self.assertIn("pool", data["pools"]["primary"])
+
+    def test_engine_options(self):
+        options = {}
+        db.apply_driver_hacks(self.app,
+                              make_url("postgresql://trivia@db/trivia"),
+                              options)
+        self.assertEqual(options["connect_args"]["options"],
+                         "-c statement_timeout={}".format(
+                             self.app.config["DB_STATEMENT_TIMEOUT"]))
+        self.assertIs(options["poolclass"], TimedQueuePool)
+
+        options = {}
+        db.apply_driver_hacks(self.app, make_url("sqlite:///trivia.db"),
+                              options)
+        self.assertIs(options["poolclass"], NullPool)
+
+        options = {}
+        db.apply_driver_hacks(self.app, make_url("sqlite://"), options)
+        self.assertIs(options["poolclass"], StaticPool)
+
+    def test_server_timing_header(self):
+        app = create_app({"SERVER_TIMING": True})
+        res = app.test_client().get("/api/v1/questions")
+
+        self.assertIn("db;dur=", res.headers["Server-Timing"])
+
+    def test_conditional_get_questions(self):
+        res = self.client().get("/api/v1/questions")
+        etag = res.headers["ETag"]
+        self.assertTrue(res.headers["Last-Modified"])
+
+        res = self.client().get("/api/v1/questions",
+                                headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b"")
+
+        self.client().post(
+            "/api/v1/questions",
+            json={"question": "What is the boiling point of water?",
+                  "answer": "100C", "category": "1", "difficulty": "1"})
+        res = self.client().get("/api/v1/questions",
+                                headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_conditional_get_modified_since(self):
+        # a write in the second still running, as far as this clock can tell
+        db.session.execute(data_version_table.update().values(
+            updated_at=datetime.utcnow() + timedelta(seconds=5)))
+        data_version.invalidate()
+        res = self.client().get("/api/v1/questions")
+        res = self.client().get(
+            "/api/v1/questions",
+            headers={"If-Modified-Since": res.headers["Last-Modified"]})
+        self.assertEqual(res.status_code, 200)
+
+        db.session.execute(data_version_table.update().values(
+            updated_at=datetime(2020, 1, 1, 12, 0, 0, 700000)))
+        data_version.invalidate()
+        res = self.client().get("/api/v1/questions")
+        self.assertEqual(res.headers["Last-Modified"],
+                         "Wed, 01 Jan 2020 12:00:00 GMT")
+        res = self.client().get(
+            "/api/v1/questions",
+            headers={"If-Modified-Since": res.headers["Last-Modified"]})
+        self.assertEqual(res.status_code, 304)
+
+    def test_response_cache(self):
+        first = self.client().get("/api/v1/questions?page=2")
+        second = self.client().get("/api/v1/questions?page=2")
+        self.assertEqual(first.data, second.data)
+
+        body = self.client().get("/metrics").data.decode()
+        self.assertIn("trivia_response_cache_hits_total 1", body)
+        self.assertIn("trivia_response_cache_misses_total 1", body)
+
+        self.client().post(
+            "/api/v1/questions",
+            json={"question": "How many legs does a spider have?",
+                  "answer": "Eight", "category": "1", "difficulty": "1"})
+        res = self.client().get("/api/v1/questions?page=2")
+        self.assertNotEqual(json.loads(res.data)["total_questions"],
+                            json.loads(first.data)["total_questions"])
+
     def test_get_all_categories(self):
         res = self.client().get("/api/v1/categories")
         data = json.loads(res.data)
@@ -56,6 +232,82 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["categories"])
         self.assertTrue(len(data["categories"]))
 
+    def test_category_write_refreshes_registry(self):
+        with self.app.app_context():
+            version = category_registry.version
+            category = Category(type="Music")
+            category.insert()
+            try:
+                self.assertGreater(category_registry.version, version)
+                res = self.client().get("/api/v1/categories")
+                data = json.loads(res.data)
+                self.assertEqual(data["categories"][str(category.id)], "Music")
+            finally:
+                category.delete()
+
+    def test_registry_sees_categories_of_other_workers(self):
+        with self.app.app_context():
+            self.assertNotIn("Music", category_registry.as_dict().values())
+            # a write from another process: no registry invalidation here
+            db.session.execute("INSERT INTO categories (type) "
+                               "VALUES ('Music')")
+            data_version.bump()
+            db.session.commit()
+            # this worker's cached data version expires
+            data_version.invalidate()
+
+            self.assertIn("Music", category_registry.as_dict().values())
+
+    def test_categories_while_registry_invalidated(self):
+        load = category_registry._ensure_loaded
+
+        def load_then_invalidate():
+            # another thread's category write lands right after the load
+            loaded = load()
+            category_registry.invalidate()
+            return loaded
+
+        category_registry._ensure_loaded = load_then_invalidate
+        try:
+            res = self.client().get("/api/v1/categories")
+        finally:
+            del category_registry._ensure_loaded
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["categories"]["1"], "Science")
+
+    def test_totals_follow_writes_of_other_workers(self):
+        self.client().get("/api/v1/questions")
+        with self.app.app_context():
+            # a write from another process: no counter update here
+            db.session.execute(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Who wrote Hamlet?', 'Shakespeare', "
+                "4, 2)")
+            question_stats.add(db.session, {(4, 2): 1})
+            data_version.bump()
+            db.session.commit()
+            # this worker's cached data version expires
+            data_version.invalidate()
+            total = db.session.execute(
+                "SELECT count(*) FROM questions").scalar()
+
+        res = self.client().get("/api/v1/questions")
+        self.assertEqual(json.loads(res.data)["total_questions"], total)
+
+    def test_update_category(self):
+        with self.app.app_context():
+            version = category_registry.version
+            category = Category.query.get(1)
+            category.type = "Natural Science"
+            category.update()
+
+            self.assertGreater(category_registry.version, version)
+            res = self.client().get("/api/v1/categories")
+            self.assertEqual(json.loads(res.data)["categories"]["1"],
+                             "Natural Science")
+
     def test_get_questions_by_category(self):
         res = self.client().get("/api/v1/categories/1/questions")
         data = json.loads(res.data)
@@ -76,6 +328,344 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_create_question_updates_total(self):
+        res = self.client().get("/api/v1/questions")
+        total = json.loads(res.data)["total_questions"]
+
+        res = self.client().post(
+            "/api/v1/questions",
+            json={"question": "What is the capital of Kenya?",
+                  "answer": "Nairobi", "category": "3", "difficulty": "2"},
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_questions"], total + 1)
+
+    def test_stats_follow_question_writes(self):
+        res = self.client().get("/api/v1/stats")
+        data = json.loads(res.data)
+        total = json.loads(
+            self.client().get("/api/v1/questions").data)["total_questions"]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_questions"], total)
+        before = data["categories"].get("2", {"total": 0, "difficulty": {}})
+
+        res = self.client().post(
+            "/api/v1/questions",
+            json={"question": "Who painted the Mona Lisa?",
+                  "answer": "Leonardo", "category": "2", "difficulty": "3"},
+        )
+        question_id = json.loads(res.data)["created"]
+        data = json.loads(self.client().get("/api/v1/stats").data)
+        self.assertEqual(data["categories"]["2"]["total"], before["total"] + 1)
+        self.assertEqual(data["categories"]["2"]["difficulty"]["3"],
+                         before["difficulty"].get("3", 0) + 1)
+
+        self.client().delete("/api/v1/questions/{}".format(question_id))
+        data = json.loads(self.client().get("/api/v1/stats").data)
+        self.assertEqual(data["categories"]["2"]["total"], before["total"])
+
+    def test_stats_follow_question_updates(self):
+        def stats():
+            return json.loads(self.client().get("/api/v1/stats").data)
+
+        before = stats()
+        with self.app.app_context():
+            question = Question.query.get(5)
+            category = str(question.category)
+            question.answer = "Maya Angelou"
+            question.update()
+            # an edit that keeps the category and difficulty changes nothing
+            self.assertEqual(stats(), before)
+
+            question.difficulty = 5 if question.difficulty != 5 else 1
+            difficulty = str(question.difficulty)
+            question.update()
+        after = stats()
+        self.assertEqual(after["total_questions"], before["total_questions"])
+        self.assertEqual(after["categories"][category]["total"],
+                         before["categories"][category]["total"])
+        self.assertEqual(
+            after["categories"][category]["difficulty"][difficulty],
+            before["categories"][category]["difficulty"].get(difficulty, 0)
+            + 1)
+
+    def test_stats_follow_category_delete(self):
+        with self.app.app_context():
+            category = Category(type="Music")
+            category.insert()
+            category_id = str(category.id)
+            Question("Who wrote the Four Seasons?", "Vivaldi",
+                     category.id, 2).insert()
+            before = json.loads(self.client().get("/api/v1/stats").data)
+            uncategorized = before["categories"].get(
+                "0", {"total": 0})["total"]
+            self.assertEqual(
+                before["categories"][category_id]["total"], 1)
+
+            category.delete()
+        data = json.loads(self.client().get("/api/v1/stats").data)
+        self.assertNotIn(category_id, data["categories"])
+        self.assertEqual(data["categories"]["0"]["total"], uncategorized + 1)
+        self.assertEqual(data["total_questions"], before["total_questions"])
+
+    def test_question_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), "questions.snapshot")
+        app = create_app({"QUESTION_SNAPSHOT": True,
+                          "QUESTION_SNAPSHOT_PATH": path,
+                          "SERVER_TIMING": True,
+                          "RESPONSE_CACHE_BYTES": 0})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+
+        for url in ("/api/v1/questions?page=2",
+                    "/api/v1/questions?after_id=10",
+                    "/api/v1/categories/1/questions"):
+            self.assertEqual(json.loads(client.get(url).data),
+                             json.loads(self.client().get(url).data))
+
+        res = client.post("/api/v1/quizzes",
+                          json={"previous_questions": [],
+                                "quiz_category": {"id": 1}})
+        self.assertEqual(json.loads(res.data)["question"]["category"], 1)
+        self.assertIn('desc="0 queries"', res.headers["Server-Timing"])
+
+        # a write bumps the data version, so the image is rebuilt
+        total = json.loads(client.get(
+            "/api/v1/categories/1/questions").data)["total_questions"]
+        client.post("/api/v1/questions",
+                    json={"question": "What is the speed of light?",
+                          "answer": "c", "category": "1", "difficulty": "2"})
+        data = json.loads(client.get("/api/v1/categories/1/questions").data)
+        self.assertEqual(data["total_questions"], total + 1)
+
+    def test_question_snapshot_is_per_database(self):
+        path = os.path.join(tempfile.mkdtemp(), "questions.snapshot")
+        store = snapshot.SnapshotStore(path)
+        with self.app.app_context():
+            # an image of another database at the same data version
+            snapshot.build_snapshot(path, b"otherdb0",
+                                    data_version.current()[0])
+            current = store.current()
+
+            self.assertEqual(store.builds, 1)
+            self.assertEqual(current.database,
+                             snapshot.database_id(db.engine.url))
+
+    def test_question_snapshot_is_private(self):
+        directory = os.path.join(tempfile.mkdtemp(), "snapshots")
+        default_directory = snapshot.SNAPSHOT_DIRECTORY
+        snapshot.SNAPSHOT_DIRECTORY = directory
+        self.addCleanup(setattr, snapshot, "SNAPSHOT_DIRECTORY",
+                        default_directory)
+        with self.app.app_context():
+            self.assertIsNotNone(snapshot.SnapshotStore(None).current())
+        (image,) = [name for name in os.listdir(directory)
+                    if name.endswith(".snapshot")]
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        self.assertEqual(
+            os.stat(os.path.join(directory, image)).st_mode & 0o777, 0o600)
+
+        # a lock planted as a symlink is not followed
+        path = os.path.join(tempfile.mkdtemp(), "questions.snapshot")
+        target = path + ".target"
+        with open(target, "w") as planted:
+            planted.write("keep")
+        os.symlink(target, path + ".lock")
+        with self.app.app_context():
+            self.assertIsNone(snapshot.SnapshotStore(path).current())
+        with open(target) as planted:
+            self.assertEqual(planted.read(), "keep")
+
+    def test_question_snapshot_unwritable_path(self):
+        app = create_app({"QUESTION_SNAPSHOT": True,
+                          "QUESTION_SNAPSHOT_PATH": "/nonexistent/q.snapshot"})
+        setup_db(app, self.database_path)
+        res = app.test_client().get("/api/v1/questions")
+
+        # served from the database instead
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(json.loads(res.data)["questions"])
+
+    def test_bulk_import_questions(self):
+        rows = [
+            {"question": "Bulk question one?", "answer": "One",
+             "category": 1, "difficulty": 1},
+            {"question": "Bulk question two?", "answer": "Two",
+             "category": 100, "difficulty": 1},
+            {"question": "Bulk question three?", "answer": "Three",
+             "category": 2, "difficulty": 2},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows) + "\nnot json\n"
+        res = self.client().post("/api/v1/questions/import", data=body,
+                                 content_type="application/x-ndjson")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["imported"], 2)
+        self.assertEqual(data["failed"], 2)
+        self.assertEqual([e["line"] for e in data["errors"]], [2, 4])
+
+    def test_bulk_import_questions_csv(self):
+        body = ("question,answer,category,difficulty\n"
+                "Bulk csv question?,Yes,3,2\n")
+        res = self.client().post("/api/v1/questions/import?format=csv",
+                                 data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["imported"], 1)
+        self.assertEqual(data["failed"], 0)
+
+    def test_bulk_import_questions_aborted(self):
+        rows = [
+            {"question": "Bulk question one?", "answer": "One",
+             "category": 1, "difficulty": 1},
+            {"question": "Bulk question two?", "answer": "Two",
+             "category": 1, "difficulty": 2 ** 70},
+            {"question": "Bulk question three?", "answer": "Three",
+             "category": 2, "difficulty": 2},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows) + "\n"
+        res = self.client().post("/api/v1/questions/import?batch_size=1",
+                                 data=body,
+                                 content_type="application/x-ndjson")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["imported"], 1)
+        self.assertEqual(data["aborted"]["first_line"], 2)
+        self.assertEqual(data["aborted"]["last_line"], 2)
+        self.assertTrue(data["aborted"]["error"])
+        res = self.client().post("/api/v1/questions/search",
+                                 json={"searchTerm": "Bulk question"})
+        self.assertEqual([question["question"]
+                          for question in json.loads(res.data)["questions"]],
+                         ["Bulk question one?"])
+
+    def test_export_questions(self):
+        res = self.client().get("/api/v1/questions/export?category=1")
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertTrue(rows)
+        self.assertTrue(all(int(row["category"]) == 1 for row in rows))
+        self.assertEqual([row["id"] for row in rows],
+                         sorted(row["id"] for row in rows))
+
+        res = self.client().get(
+            "/api/v1/questions/export?category=1&after_id={}".format(
+                rows[0]["id"]))
+        resumed = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(resumed, rows[1:])
+
+    def test_create_question_minimal_response(self):
+        res = self.client().post(
+            "/api/v1/questions",
+            json={"question": "What colour is the sky?",
+                  "answer": "Blue", "category": "1", "difficulty": "1"},
+            headers={"Prefer": "return=minimal"},
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["created"])
+        self.assertNotIn("questions", data)
+        self.assertEqual(res.headers["Preference-Applied"], "return=minimal")
+
+        res = self.client().delete(
+            "/api/v1/questions/{}?fields=deleted".format(data["created"]))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["deleted"])
+        self.assertNotIn("questions", data)
+
+    @contextmanager
+    def held_write_batches(self, size):
+        # the write queue waits for `size` writes before it commits, so
+        # writes sent together always share a batch
+        batch_size, max_delay = write_queue.batch_size, write_queue.max_delay
+        write_queue.batch_size, write_queue.max_delay = size, 10000
+        try:
+            yield
+        finally:
+            write_queue.batch_size = batch_size
+            write_queue.max_delay = max_delay
+
+    @commits
+    def test_write_behind_group_commit(self):
+        app = create_app({"WRITE_BEHIND": True})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        batches = write_queue.batches
+        created = []
+
+        def create(number):
+            res = client.post(
+                "/api/v1/questions",
+                json={"question": "Group commit question {}?".format(number),
+                      "answer": "Yes", "category": "1", "difficulty": "1"},
+                headers={"Prefer": "return=minimal"})
+            created.append(json.loads(res.data)["created"])
+
+        threads = [threading.Thread(target=create, args=(number,))
+                   for number in range(8)]
+        with self.held_write_batches(8):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(set(created)), 8)
+        self.assertTrue(all(created))
+        self.assertEqual(write_queue.batches - batches, 1)
+
+        for question_id in created:
+            res = client.delete("/api/v1/questions/{}".format(question_id),
+                                headers={"Prefer": "return=minimal"})
+            self.assertEqual(res.status_code, 200)
+        res = client.delete("/api/v1/questions/{}".format(created[0]))
+        self.assertEqual(res.status_code, 404)
+
+    @commits
+    def test_write_behind_failed_write(self):
+        app = create_app({"WRITE_BEHIND": True})
+        setup_db(app, self.database_path)
+        batches = write_queue.batches
+        results = {}
+
+        def insert(number):
+            values = {"question": "Failing batch question {}?".format(number),
+                      "answer": "Yes", "category": 1, "difficulty": 1}
+            if number == 2:
+                # a write whose statement fails on every database
+                values["no_such_column"] = 1
+            try:
+                results[number] = write_queue.insert(values)
+            except Exception as error:
+                results[number] = error
+
+        threads = [threading.Thread(target=insert, args=(number,))
+                   for number in range(4)]
+        with self.held_write_batches(4):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # one batch, retried write by write after it failed
+        self.assertEqual(write_queue.batches - batches, 1)
+        self.assertIsInstance(results.pop(2), Exception)
+        self.assertTrue(all(isinstance(question_id, int)
+                            for question_id in results.values()))
+        for question_id in results.values():
+            self.assertEqual(write_queue.delete((question_id, 1, 1)), 1)
+
     def test_search_questions(self):
         res = self.client().post("/api/v1/questions/search",
                                  json={"searchTerm": "a"})
@@ -86,6 +676,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total_questions"])
         self.assertTrue(len(data["questions"]))
 
+    def test_search_questions_is_ranked_and_paginated(self):
+        res = self.client().post("/api/v1/questions/search",
+                                 json={"searchTerm": "what", "limit": 1})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["questions"]), 1)
+        self.assertGreater(data["total_questions"], 1)
+        self.assertIn("what", data["questions"][0]["question"].lower())
+
+        res = self.client().post("/api/v1/questions/search",
+                                 json={"searchTerm": "what", "limit": 1,
+                                       "page": 2})
+        second = json.loads(res.data)
+        self.assertNotEqual(second["questions"][0]["id"],
+                            data["questions"][0]["id"])
+
+    def test_search_questions_without_matches(self):
+        res = self.client().post("/api/v1/questions/search",
+                                 json={"searchTerm": "xyzzyplugh"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_questions"], 0)
+        self.assertEqual(data["questions"], [])
+
     def test_create_question_with_no_question(self):
         res = self.client().post(
             "/api/v1/questions",
@@ -159,6 +775,71 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
 
+    def test_play_quiz(self):
+        res = self.client().post("/api/v1/quizzes",
+                                 json={"quiz_category": {"id": 1},
+                                       "previous_questions": [20, 21]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(int(data["question"]["category"]), 1)
+        self.assertNotIn(data["question"]["id"], [20, 21])
+
+    def test_play_quiz_batch(self):
+        res = self.client().post("/api/v1/quizzes",
+                                 json={"quiz_category": {"id": 0},
+                                       "previous_questions": [5, 9],
+                                       "count": 5})
+        data = json.loads(res.data)
+        ids = [q["id"] for q in data["questions"]]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertFalse({5, 9} & set(ids))
+
+    def test_play_quiz_all_questions_played(self):
+        res = self.client().get("/api/v1/categories/1/questions")
+        played = [q["id"] for q in json.loads(res.data)["questions"]]
+
+        res = self.client().post("/api/v1/quizzes",
+                                 json={"quiz_category": {"id": 1},
+                                       "previous_questions": played})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["question"], None)
+
+    def test_quiz_session_deals_each_question_once(self):
+        res = self.client().post("/api/v1/quizzes/sessions",
+                                 json={"quiz_category": {"id": 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["session_id"])
+        total = data["total_questions"]
+        self.assertTrue(total)
+
+        url = "/api/v1/quizzes/sessions/{}/next".format(data["session_id"])
+        seen = []
+        for _ in range(total):
+            data = json.loads(self.client().post(url).data)
+            self.assertEqual(int(data["question"]["category"]), 1)
+            seen.append(data["question"]["id"])
+        self.assertEqual(len(set(seen)), total)
+
+        data = json.loads(self.client().post(url).data)
+        self.assertEqual(data["question"], None)
+        self.assertEqual(data["remaining"], 0)
+
+    def test_404_quiz_session_unknown(self):
+        res = self.client().post("/api/v1/quizzes/sessions/nope/next")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
     def test_play_quiz_failure(self):
         res = self.client().post("/api/v1/quizzes",
                                  json={"quiz_category": "10"})
@@ -168,6 +849,60 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "unprocessable")
 
+    @unittest.skipUnless(asgi.asyncpg and
+                         TransactionalTestCase.database_path.startswith(
+                             "postgres"), "needs asyncpg and Postgres")
+    def test_async_api_matches_flask(self):
+        api = asgi.AsyncReadAPI(
+            self.database_path.replace("+psycopg2", ""), 1, 2)
+
+        async def call(method, path, body=None):
+            messages = [{"type": "http.request",
+                         "body": json.dumps(body).encode() if body else b""}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            path, _, query_string = path.partition("?")
+            await api({"type": "http", "method": method, "path": path,
+                       "query_string": query_string.encode()}, receive, send)
+            return sent[0]["status"], json.loads(sent[1]["body"])
+
+        # all but one question of category 1 played, so both draw the same
+        res = self.client().get("/api/v1/questions/export?category=1")
+        played = [json.loads(line)["id"] for line in res.data.splitlines()]
+        last_question = {"quiz_category": {"id": 1},
+                         "previous_questions": played[:-1]}
+
+        async def compare():
+            try:
+                for method, path, body in (
+                        ("GET", "/api/v1/categories", None),
+                        ("GET", "/api/v1/questions", None),
+                        ("GET", "/api/v1/questions?page=2", None),
+                        ("GET", "/api/v1/questions?after_id=5", None),
+                        ("GET", "/api/v1/questions?ids=9,5,1000", None),
+                        ("GET", "/api/v1/categories/1/questions", None),
+                        ("POST", "/api/v1/questions/search",
+                         {"searchTerm": "what"}),
+                        ("POST", "/api/v1/questions/search",
+                         {"searchTerm": "what the", "page": 2, "limit": 2}),
+                        ("POST", "/api/v1/quizzes", last_question),
+                        ("POST", "/api/v1/quizzes",
+                         dict(last_question, count=5)),
+                        ("POST", "/api/v1/quizzes", {"quiz_category": "1"})):
+                    res = self.client().open(path, method=method, json=body)
+                    self.assertEqual(await call(method, path, body),
+                                     (res.status_code, json.loads(res.data)))
+            finally:
+                await api.close()
+
+        asyncio.run(compare())
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
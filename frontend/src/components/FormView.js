@@ -34,6 +34,7 @@ class FormView extends Component {
 		$.ajax({
 			url: '/api/v1/questions', //TODO: update request URL
 			type: 'POST',
+			headers: { Prefer: 'return=minimal' },
 			dataType: 'json',
 			contentType: 'application/json',
 			data: JSON.stringify({
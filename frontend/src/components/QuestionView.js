@@ -114,6 +114,7 @@ class QuestionView extends Component {
 				$.ajax({
 					url: `/api/v1/questions/${id}`, //TODO: update request URL
 					type: 'DELETE',
+					headers: { Prefer: 'return=minimal' },
 					success: (result) => {
 						this.getQuestions();
 					},